@@ -1,70 +1,67 @@
-import json
-
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-
-from shared.database import SessionLocal
-from shared.publisher import Publisher
-from shared.redis_client import RedisClient
-from shared.mongodb_client import MongoDBClient
-from shared.elasticsearch_client import ElasticsearchClient
+import os
+
+from asyncpg import Connection
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from shared import codec
+from shared.database import AsyncSessionLocal
+from shared.bucket_cache import AsyncBucketCache
+from shared.publisher import AsyncPublisher
+from shared.registry import registry
+from shared.sensor_cache import SensorCache
+from shared.redis_client import AsyncRedisClient
+from shared.mongodb_client import AsyncMongoDBClient
+from shared.elasticsearch_client import AsyncElasticsearchClient
 from shared.sensors.repository import DataCommand
-from shared.timescale import Timescale
-from shared.cassandra_client import CassandraClient
-from shared.sensors import repository, schemas
+from shared.cassandra_client import AsyncCassandraClient
+from shared.sensors import export, repository, schemas
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_timescale():
-    ts = Timescale()
-    try:
+# The clients come from the process-wide registry, they are pooled and shared
+# between requests so they must not be closed here. The dependencies are coroutines
+# so FastAPI doesn't send them to its threadpool
+
+async def get_timescale():
+    async with registry.timescale().acquire() as ts:
         yield ts
-    finally:
-        ts.close()
+
+# Dependency to get the sensor metadata cache
+async def get_sensor_cache():
+    return registry.sensor_cache()
 
 # Dependency to get redis client
 
-def get_redis_client():
-    redis = RedisClient(host="redis")
-    try:
-        yield redis
-    finally:
-        redis.close()
+async def get_redis_client():
+    return registry.redis()
 
 # Dependency to get mongodb client
 
-def get_mongodb_client():
-    mongodb = MongoDBClient(host="mongodb")
-    try:
-        yield mongodb
-    finally:
-        mongodb.close()
+async def get_mongodb_client():
+    return registry.mongodb()
 
 # Dependency to get elastic_search client
-def get_elastic_search():
-    es = ElasticsearchClient(host="elasticsearch")
-    try:
-        yield es
-    finally:
-        es.close()
+async def get_elastic_search():
+    return registry.elasticsearch()
 
 # Dependency to get cassandra client
-def get_cassandra_client():
-    cassandra = CassandraClient(hosts=["cassandra"])
-    try:
-        yield cassandra
-    finally:
-        cassandra.close()
+async def get_cassandra_client():
+    return registry.cassandra()
 
+# Dependency to get the cache of aggregated buckets
+async def get_bucket_cache():
+    return registry.bucket_cache()
+
+# Dependency to get the rabbitmq publisher
+async def get_publisher():
+    return registry.publisher()
 
-publisher = Publisher()
 
 router = APIRouter(
     prefix="/sensors",
@@ -74,84 +71,145 @@ router = APIRouter(
 
 
 # 🙋🏽‍♀️ Add here the route to get a list of sensors near to a given location
+# - radius: distance in metres
+# - limit (optional): maximum number of sensors, closest first
 @router.get("/near")
-@router.get("/near")
-def get_sensors_near(latitude: float, longitude: float, radius:float, mongodb_client: MongoDBClient = Depends(get_mongodb_client), redis_client: RedisClient = Depends(get_redis_client), db: Session = Depends(get_db)):
-    return repository.get_sensor_near(mongodb= mongodb_client, redis=redis_client, latitude=latitude, longitude=longitude, radius=radius, db=db)
+async def get_sensors_near(latitude: float, longitude: float, radius:float, limit: int = 100, mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), redis_client: AsyncRedisClient = Depends(get_redis_client)):
+    return await repository.get_sensor_near(mongodb= mongodb_client, redis=redis_client, latitude=latitude, longitude=longitude, radius=radius, limit=limit)
 
 # 🙋🏽‍♀️ Add here the route to search sensors by query to Elasticsearch
 # Parameters:
 # - query: string to search
 # - size (optional): number of results to return
+# - skip (optional): number of results to skip, for pagination
 # - search_type (optional): type of search to perform
-# - db: database session
-# - mongodb_client: mongodb client
 @router.get("/search")
-def search_sensors(query: str, size: int = 10, search_type: str = "match", db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search)):
-    return repository.search_sensors(db=db,mongodb=mongodb_client, elastic=es, query=query, size=size, search_type=search_type)
+async def search_sensors(query: str, size: int = 10, skip: int = 0, search_type: str = "match", es: AsyncElasticsearchClient = Depends(get_elastic_search)):
+    return await repository.search_sensors(elastic=es, query=query, size=size, search_type=search_type, skip=skip)
 
 
 @router.get("/temperature/values")
-def get_temperature_values(mongodb: Session = Depends(get_mongodb_client), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_temperature_values(mongodb=mongodb, cassandra=cassandra_client)
+async def get_temperature_values(mongodb: AsyncMongoDBClient = Depends(get_mongodb_client), cassandra_client: AsyncCassandraClient = Depends(get_cassandra_client)):
+    return await repository.get_temperature_values(mongodb=mongodb, cassandra=cassandra_client)
 
 @router.get("/quantity_by_type")
-def get_sensors_quantity(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_sensors_quantity(db=db, cassandra_client=cassandra_client)
+async def get_sensors_quantity(db: AsyncSession = Depends(get_db), cassandra_client: AsyncCassandraClient = Depends(get_cassandra_client)):
+    return await repository.get_sensors_quantity(db=db, cassandra_client=cassandra_client)
 
+# - threshold (optional): highest battery level to include
+# - skip, limit (optional): pagination, sensors are sorted by battery level
 @router.get("/low_battery")
-def get_low_battery_sensors(mongodb: Session = Depends(get_mongodb_client), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_low_battery_sensors(mongodb=mongodb, cassandra=cassandra_client)
+async def get_low_battery_sensors(threshold: float = 0.2, skip: int = 0, limit: int = 100, mongodb: AsyncMongoDBClient = Depends(get_mongodb_client), redis_client: AsyncRedisClient = Depends(get_redis_client)):
+    return await repository.get_low_battery_sensors(mongodb=mongodb, redis=redis_client, threshold=threshold, skip=skip, limit=limit)
 
 # 🙋🏽‍♀️ Add here the route to get all sensors
 @router.get("")
-def get_sensors(db: Session = Depends(get_db)):
-    return repository.get_sensors(db)
+async def get_sensors(db: AsyncSession = Depends(get_db)):
+    return await repository.get_sensors(db)
 
 # 🙋🏽‍♀️ Add here the route to create a sensor
 @router.post("")
-def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client),elastic_client: ElasticsearchClient=Depends(get_elastic_search), cassandra: CassandraClient=Depends(get_cassandra_client)):
-    db_sensor = repository.get_sensor_by_name(db, sensor.name)
+async def create_sensor(sensor: schemas.SensorCreate, db: AsyncSession = Depends(get_db), mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), cassandra: AsyncCassandraClient=Depends(get_cassandra_client), redis: AsyncRedisClient = Depends(get_redis_client), publisher: AsyncPublisher = Depends(get_publisher), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    db_sensor = await repository.get_sensor_by_name(db, sensor.name)
     if db_sensor:
         raise HTTPException(status_code=400, detail="Sensor with same name already registered")
-    return repository.create_sensor(db=db, sensor=sensor,mongodb=mongodb_client, elastic=elastic_client, cassandra=cassandra)
+    return await repository.create_sensor(db=db, sensor=sensor,mongodb=mongodb_client, publisher=publisher, cassandra=cassandra, redis=redis, cache=sensor_cache)
 
 
 # 🙋🏽‍♀️ Add here the route to get a sensor by id
 @router.get("/{sensor_id}")
-def get_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
-    db_sensor = repository.get_sensor(mongodb_client, sensor_id)
+async def get_sensor(sensor_id: int, mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    db_sensor = await repository.get_sensor(mongodb_client, sensor_id, cache=sensor_cache)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
     return db_sensor
 
 # 🙋🏽‍♀️ Add here the route to delete a sensor
 @router.delete("/{sensor_id}")
-def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client),timescale: Timescale = Depends(get_timescale), redis: RedisClient = Depends(get_redis_client)):
-    db_sensor = repository.get_sensor(mongodb_client, sensor_id)
-    if db_sensor is None:
+async def delete_sensor(sensor_id: int, db: AsyncSession = Depends(get_db), mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), timescale: Connection = Depends(get_timescale), redis: AsyncRedisClient = Depends(get_redis_client), cassandra_client: AsyncCassandraClient = Depends(get_cassandra_client), publisher: AsyncPublisher = Depends(get_publisher), sensor_cache: SensorCache = Depends(get_sensor_cache), bucket_cache: AsyncBucketCache = Depends(get_bucket_cache)):
+    sensor = await repository.get_sensor(mongodb_client, sensor_id)
+    if sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
     
-    return repository.delete_sensor(db=db, sensor_id=sensor_id, mongodb=mongodb_client, redis=redis, ts=timescale)
+    return await repository.delete_sensor(db=db, sensor=sensor, mongodb=mongodb_client, redis=redis, ts=timescale, cassandra=cassandra_client, publisher=publisher, cache=sensor_cache, bucket_cache=bucket_cache)
 
 # 🙋🏽‍♀️ Add here the route to update a sensor
-@router.post("/{sensor_id}/data")
-def record_data(sensor_id: int, data: schemas.SensorData,db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale),mongodb_client: MongoDBClient = Depends(get_mongodb_client), cassandra_client = Depends(get_cassandra_client)):
-    db_sensor = repository.get_sensor(mongodb_client, sensor_id=sensor_id)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 10000))
+
+async def read_ndjson(request: Request) -> list:
+    # Decodes the body line by line as it arrives, a bad line is kept as its exception
+    items, buffer = [], b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        items.extend(decode_line(line) for line in lines if line.strip())
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} readings per batch")
+    if buffer.strip():
+        items.append(decode_line(buffer))
+    return items
+
+def decode_line(line: bytes):
+    try:
+        return codec.json_loads(line)
+    except ValueError as e:
+        return e
+
+# Readings of many sensors in one request, as a JSON array or as NDJSON (Content-Type: application/x-ndjson).
+# Each item is {sensor_id, ...SensorData}, the response says which ones were accepted or rejected
+@router.post("/data/batch", status_code=202)
+async def record_data_batch(request: Request, mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), publisher: AsyncPublisher = Depends(get_publisher), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = await read_ndjson(request)
+    else:
+        try:
+            items = codec.json_loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} readings per batch")
+    return await repository.publish_data_batch(publisher=publisher, mongodb=mongodb_client, items=items, cache=sensor_cache)
+
+# The reading is only validated and queued here, the consumer does the writes
+@router.post("/{sensor_id}/data", status_code=202)
+async def record_data(sensor_id: int, data: schemas.SensorData, mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), publisher: AsyncPublisher = Depends(get_publisher), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    db_sensor = await repository.get_sensor(mongodb_client, sensor_id=sensor_id, cache=sensor_cache)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    return repository.record_data(redis=redis_client, sensor_id=sensor_id, data=data, ts=timescale, cassandra=cassandra_client)
+    return await repository.publish_data(publisher=publisher, sensor_id=sensor_id, data=data)
 
 # 🙋🏽‍♀️ Add here the route to get data from a sensor
 @router.get("/{sensor_id}/data")
-def get_data(sensor_id: int, request: Request, db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale),  mongodb_client: MongoDBClient = Depends(get_mongodb_client)):    
-    db_sensor = repository.get_sensor(mongodb=mongodb_client, sensor_id=sensor_id)
-    
-    if db_sensor is None: 
+async def get_data(sensor_id: int, request: Request, redis_client: AsyncRedisClient = Depends(get_redis_client), mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), bucket_cache: AsyncBucketCache = Depends(get_bucket_cache), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    from_ = request.query_params.get('from')
+    to = request.query_params.get("to")
+    bucket = request.query_params.get("bucket")
+
+    # Only the history needs the sensor lookup and timescale, the latest-value hash only
+    # exists for registered sensors
+    timescale = None
+    if from_ is not None and to is not None and bucket is not None:
+        db_sensor = await repository.get_sensor(mongodb=mongodb_client, sensor_id=sensor_id, cache=sensor_cache)
+        if db_sensor is None:
+            raise HTTPException(status_code=404, detail="Sensor not found")
+        timescale = registry.timescale()
+
+    return await repository.get_data(redis=redis_client, sensor_id=sensor_id, timescale=timescale, from_=from_, to=to, bucket=bucket, cache=bucket_cache)
+
+# Streams the readings of a sensor, or its bucketed aggregates with bucket, chunk by chunk
+# - format: ndjson, csv or arrow (IPC stream, needs pyarrow)
+@router.get("/{sensor_id}/data/export")
+async def export_data(sensor_id: int, from_: str = Query(alias="from"), to: str = Query(), format: str = "ndjson", bucket: str = None, timescale: Connection = Depends(get_timescale), mongodb_client: AsyncMongoDBClient = Depends(get_mongodb_client), sensor_cache: SensorCache = Depends(get_sensor_cache)):
+    if format not in export.SERIALIZERS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(export.SERIALIZERS)}")
+    if format == "arrow" and not export.arrow_available():
+        raise HTTPException(status_code=501, detail="Arrow export is not available on this server")
+    if await repository.get_sensor(mongodb_client, sensor_id, cache=sensor_cache) is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    
-    from_ = request.query_params['from']
-    to = request.query_params["to"]
-    bucket = request.query_params["bucket"]
 
-    return repository.get_data(redis=redis_client, sensor_id=sensor_id, db=db, ts=timescale, from_=from_, to=to, bucket=bucket)
+    # The pooled connection is released once the whole response has been sent
+    columns, chunks = repository.export_data(ts=timescale, sensor_id=sensor_id, from_=from_, to=to, bucket=bucket)
+    filename = f"sensor_{sensor_id}.{format}"
+    return StreamingResponse(export.SERIALIZERS[format](columns, chunks), media_type=export.MEDIA_TYPES[format], headers={"Content-Disposition": f"attachment; filename={filename}"})
@@ -1,5 +1,6 @@
 from fastapi.testclient import TestClient
 import pytest
+from app import migrate
 from app.main import app
 from shared.redis_client import RedisClient
 from shared.mongodb_client import MongoDBClient
@@ -24,22 +25,41 @@ def clear_dbs():
      mongo.close()
      es = ElasticsearchClient(host="elasticsearch")
      es.clearIndex("sensors")  
+     # The rollback drops the continuous aggregates and forgets the migrations, CASCADE covers
+     # whatever else still depends on the hypertable
+     migrate.rollback_migrations(migrate.TIMESCALE_URL, "migrations_ts")
      ts = Timescale()
-     ts.execute("DROP TABLE IF EXISTS sensor_data")
+     ts.execute("DROP TABLE IF EXISTS sensor_data CASCADE")
+     ts.commit()
      ts.close()
 
      while True:
         try:
-            cassandra = CassandraClient(["cassandra"])
+            cassandra = CassandraClient(["cassandra"], create_schema=True)
             cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
             cassandra.close()
             break
         except Exception as e:
             time.sleep(5)
 
+     # Create the schemas again before starting the app, as the migrate service does
+     migrate.apply_migrations(migrate.TIMESCALE_URL, "migrations_ts")
+     migrate.create_cassandra_schema()
+     migrate.create_elasticsearch_index()
+     migrate.create_mongodb_indexes()
+     with client:
+        yield
+
 
 #TODO ADD all your tests in test_*.py files:
 
+def test_health():
+    assert client.get("/health/live").status_code == 200
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["ready"]
+    assert set(response.json()["startup"]) == {"import_s", "lifespan_s", "backends"}
+
 #TEST CLAU-VALOR
 def test_redis_connection():
     redis_client = RedisClient(host="redis")
@@ -179,35 +199,37 @@ def test_create_sensor_temperatura_2():
 #TEST COLUMNARS
 def test_post_sensor_data_temperatura_1():
     response = client.post("/sensors/1/data", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_post_sensor_data_temperatura_2():
     response = client.post("/sensors/1/data", json={"temperature": 4.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_post_sensor_data_temperatura_3():
     response = client.post("/sensors/4/data", json={"temperature": 15.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_post_sensor_data_temperatura_4():
     response = client.post("/sensors/4/data", json={"temperature": 17.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_post_sensor_data_veolicitat_1():
     response = client.post("/sensors/2/data", json={"velocity": 1.0, "battery_level": 0.1, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_post_sensor_data_veolicitat_2():
     response = client.post("/sensors/3/data", json={"velocity": 15.0, "battery_level": 0.15, "last_seen": "2020-01-01T01:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST COLUMNARS
 def test_get_values_sensor_temperatura():
+    # Wait for the consumer to write the readings
+    time.sleep(2)
     response = client.get("/sensors/temperature/values")
     assert response.status_code == 200
     assert response.json() == {"sensors": [{"id": 1, "name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": {"max_temperature": 4.0, "min_temperature": 1.0, "average_temperature": 2.5}}, {"id": 4, "name": "Sensor Temperatura 2", "latitude": 2.0, "longitude": 2.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:03", "manufacturer": "Dummy", "model": "Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy", "values": {"max_temperature": 17.0, "min_temperature": 15.0, "average_temperature": 16.0}}]}
@@ -224,53 +246,70 @@ def test_get_sensors_low_battery():
     assert response.status_code == 200
     assert response.json() == {"sensors": [{"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1", "battery_level": 0.1}, {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2", "battery_level": 0.15}]}
 
+#TEST TEMPORALS
+def test_post_sensor_data_batch_rejects_invalid_items():
+    response = client.post("/sensors/data/batch", json=[{"sensor_id": 999, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"}, {"sensor_id": 1, "temperature": 1.0}])
+    assert response.status_code == 202
+    json = response.json()
+    assert (json["accepted"], json["rejected"]) == (0, 2)
+    assert json["results"][0] == {"index": 0, "status": "rejected", "error": "Sensor not found"}
+
+#TEST TEMPORALS
+def test_post_sensor_data_batch_ndjson():
+    body = '{"sensor_id": 999, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"}\nnot json\n'
+    response = client.post("/sensors/data/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 202
+    assert [r["status"] for r in response.json()["results"]] == ["rejected", "rejected"]
+
 #TEST TEMPORALS
 def test_post_sensor_data_dia_1():
     response = client.post("/sensors/1/data", json={"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_dia_2():
     response = client.post("/sensors/1/data", json={"temperature": 15.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-02T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_dia_3():
     response = client.post("/sensors/1/data", json={"temperature": 18.0, "humidity": 1.0, "battery_level": 0.9, "last_seen": "2020-01-03T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_hora_1():
     response = client.post("/sensors/2/data", json={"velocity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_hora_2():
     response = client.post("/sensors/2/data", json={"velocity": 15.0, "battery_level": 1.0, "last_seen": "2020-01-01T01:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_hora_3():
     response = client.post("/sensors/2/data", json={"velocity": 18.0, "battery_level": 0.9, "last_seen": "2020-01-01T02:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_week_1():
     response = client.post("/sensors/3/data", json={"velocity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_week_2():
     response = client.post("/sensors/3/data", json={"velocity": 15.0, "battery_level": 1.0, "last_seen": "2020-01-08T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_post_sensor_data_veolicitat_week_3():
     response = client.post("/sensors/3/data", json={"velocity": 18.0, "battery_level": 0.9, "last_seen": "2020-01-15T00:00:00.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST TEMPORALS
 def test_get_sensor_data_1_day():
+    # Wait for the consumer to write the readings
+    time.sleep(2)
     """We can get a sensor by its id"""
     response = client.get("/sensors/1/data?from=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day")
     print(response.json())
@@ -316,15 +355,17 @@ def test_get_sensor_data_3_month():
 #TEST DOCUMENTALS
 def test_update_sensor_1_data():
     response = client.post("/sensors/1/data", json={"temperature": 2.0, "humidity": 2.0, "battery_level": 1.9, "last_seen": "2020-01-01T00:00:01.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST DOCUMENTALS
 def test_update_sensor_2_data():
     response = client.post("/sensors/2/data", json={"velocity": 46.0,"battery_level": 1.9, "last_seen": "2020-01-01T00:00:01.000Z"})
-    assert response.status_code == 200
+    assert response.status_code == 202
 
 #TEST DOCUMENTALS
 def test_get_near():
+    # Wait for the consumer to write the readings
+    time.sleep(2)
     response = client.get("/sensors/near?latitude=1.0&longitude=1.0&radius=1")
     assert response.status_code == 200
     json = response.json()
@@ -0,0 +1,52 @@
+"""Statements per second writing readings to Cassandra.
+
+Compares the old path (CQL built by string concatenation, executed one after
+another) with prepared statements sent through CassandraClient.execute_bulk.
+
+    python -m benchmarks.cassandra_statements --hosts cassandra -n 5000
+"""
+import argparse
+import random
+import time
+
+from shared.cassandra_client import CassandraClient
+
+TABLE = "sensor.bench_temp_values"
+
+
+def concatenated(cassandra, readings):
+    for sensor_id, temp in readings:
+        cassandra.get_session().execute("INSERT INTO " + TABLE + " (sensor_id, temp) VALUES (" + str(sensor_id) + ", " + str(temp) + ");")
+
+
+def prepared_bulk(cassandra, readings, concurrency):
+    cassandra.execute_concurrent("INSERT INTO " + TABLE + " (sensor_id, temp) VALUES (?, ?);", readings, concurrency=concurrency)
+
+
+def measure(name, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {n / elapsed:>10.0f} statements/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", nargs="+", default=["cassandra"])
+    parser.add_argument("-n", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    cassandra = CassandraClient(hosts=args.hosts)
+    cassandra.get_session().execute("CREATE TABLE IF NOT EXISTS " + TABLE + "(sensor_id INT, temp FLOAT, PRIMARY KEY(sensor_id, temp));")
+    readings = [(random.randint(1, 1000), round(random.uniform(-20, 40), 2)) for _ in range(args.n)]
+    try:
+        measure("concatenated, sequential (before)", lambda: concatenated(cassandra, readings), args.n)
+        measure(f"prepared, concurrency={args.concurrency} (after)", lambda: prepared_bulk(cassandra, readings, args.concurrency), args.n)
+    finally:
+        cassandra.get_session().execute("DROP TABLE IF EXISTS " + TABLE + ";")
+        cassandra.close()
+
+
+if __name__ == "__main__":
+    main()
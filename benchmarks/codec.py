@@ -0,0 +1,84 @@
+"""Bytes per reading and encode/decode time of the queue and Redis payloads.
+
+Compares the old JSON path (json.dumps of {sensor_id, ...SensorData} dicts, decoded back
+into validated SensorData) with shared.codec, for single readings and for the messages
+of POST /sensors/data/batch. Needs no services:
+
+    python -m benchmarks.codec -n 20000 --batch 500
+"""
+import argparse
+import json
+import random
+import time
+
+from shared import codec
+from shared.sensors import schemas
+
+
+def readings(n):
+    return [(random.randint(1, 1000), schemas.SensorData(
+        velocity=round(random.uniform(0, 30), 2) if random.random() < 0.5 else None,
+        temperature=round(random.uniform(-20, 40), 2),
+        humidity=round(random.uniform(0, 100), 2),
+        battery_level=round(random.random(), 2),
+        last_seen="2020-01-01T00:00:00.000Z")) for _ in range(n)]
+
+
+def json_encode(chunk):
+    return json.dumps([{"sensor_id": sensor_id, **data.dict()} for sensor_id, data in chunk]).encode()
+
+
+def json_decode(body):
+    readings = []
+    for message in json.loads(body):
+        sensor_id = message.pop("sensor_id")
+        readings.append((sensor_id, schemas.SensorData(**message)))
+    return readings
+
+
+def measure(name, encode, decode, data, batch):
+    chunks = [data[start:start + batch] for start in range(0, len(data), batch)]
+    start = time.perf_counter()
+    bodies = [encode(chunk) for chunk in chunks]
+    encoded = time.perf_counter() - start
+    start = time.perf_counter()
+    for body in bodies:
+        decode(body)
+    decoded = time.perf_counter() - start
+    size = sum(len(body) for body in bodies)
+    print(f"{name:<24} {size / len(data):>8.1f} bytes/reading {encoded / len(data) * 1e6:>8.2f} us encode {decoded / len(data) * 1e6:>8.2f} us decode")
+
+
+def measure_values(name, dumps, loads, values):
+    start = time.perf_counter()
+    bodies = [dumps(value) for value in values]
+    encoded = time.perf_counter() - start
+    start = time.perf_counter()
+    for body in bodies:
+        loads(body)
+    decoded = time.perf_counter() - start
+    size = sum(len(body) for body in bodies)
+    print(f"{name:<24} {size / len(values):>8.1f} bytes/value   {encoded / len(values) * 1e6:>8.2f} us encode {decoded / len(values) * 1e6:>8.2f} us decode")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    data = readings(args.n)
+    for batch in (1, args.batch):
+        print(f"queue, {batch} reading(s) per message")
+        measure("  json", json_encode, json_decode, data, batch)
+        measure("  codec", codec.encode_readings, codec.decode_readings, data, batch)
+
+    # Latest values in Redis
+    latest = [data.dict() for _, data in data]
+    print("redis latest value")
+    measure_values("  json", lambda value: json.dumps(value).encode(), json.loads, latest)
+    measure_values("  codec", codec.dumps, codec.loads, latest)
+
+
+if __name__ == "__main__":
+    main()
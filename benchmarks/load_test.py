@@ -0,0 +1,75 @@
+"""Requests per second and latency percentiles of the sensors API at a fixed concurrency.
+
+Run it against a single API worker before and after a change, with the same
+concurrency, and compare the requests per second at equal p99:
+
+    uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers 1
+    python -m benchmarks.load_test --url http://localhost:8000 --concurrency 64 --duration 30
+
+The default mix reads and ingests against the sensors that already exist (ids 1..--sensors).
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+READ_PATHS = [
+    "/sensors/{id}",
+    "/sensors/{id}/data?from=2020-01-01T00:00:00.000Z&to=2020-01-31T00:00:00.000Z&bucket=day",
+    "/sensors/near?latitude=1.0&longitude=1.0&radius=100000",
+    "/sensors/low_battery",
+    "/sensors/temperature/values",
+    "/sensors/quantity_by_type",
+]
+
+
+async def request(client, sensors):
+    sensor_id = random.randint(1, sensors)
+    if random.random() < 0.5:
+        reading = {"temperature": round(random.uniform(-20, 40), 2), "humidity": 50.0, "battery_level": 0.9, "last_seen": "2020-01-01T00:00:00.000Z"}
+        return await client.post(f"/sensors/{sensor_id}/data", json=reading)
+    return await client.get(random.choice(READ_PATHS).format(id=sensor_id))
+
+
+async def user(client, sensors, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await request(client, sensors)
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--sensors", type=int, default=4)
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(*[user(client, args.sensors, deadline, latencies, errors) for _ in range(args.concurrency)])
+
+    latencies.sort()
+    print(f"requests     {len(latencies)}")
+    print(f"errors       {len(errors)}")
+    print(f"requests/s   {len(latencies) / args.duration:.1f}")
+    for p in (0.5, 0.9, 0.99):
+        print(f"p{int(p * 100):<11} {percentile(latencies, p) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,64 @@
-import json
+import argparse
+import multiprocessing
+import signal
+import sys
+import time
 
-from shared.subscriber import Subscriber
+from consumer.workers import WORKERS
+from shared.publisher import SENSOR_PARTITIONS
 
-subscriber = Subscriber()
+# Usage: python -m consumer.main <timescale|cassandra|redis|elasticsearch> [--partitions 0 1 ...]
+# Runs one process per partition queue of the sink, all of them by default. Only one process
+# may consume a partition at a time, that is what keeps each sensor's readings in order.
+# Sinks with a queue of their own (elasticsearch) run a single worker in this process.
 
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
-    print("Received data:", data)
+def run_worker(name, partition):
+    WORKERS[name](partition).run()
 
 
-subscriber.subscribe(callback)
+def supervise(name, partitions):
+    # A worker that dies is started again on the same partition
+    processes = {}
+
+    def start(partition):
+        process = multiprocessing.Process(target=run_worker, args=(name, partition), name=f"{name}-{partition}")
+        process.start()
+        processes[partition] = process
+
+    for partition in partitions:
+        start(partition)
+    try:
+        while True:
+            time.sleep(1)
+            for partition, process in list(processes.items()):
+                if not process.is_alive():
+                    print(f"[{name}:{partition}] Worker exited with code {process.exitcode}, restarting")
+                    start(partition)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m consumer.main")
+    parser.add_argument("sink", choices=list(WORKERS))
+    parser.add_argument("--partitions", type=int, nargs="+", default=list(range(SENSOR_PARTITIONS)))
+    args = parser.parse_args()
+
+    worker = WORKERS[args.sink]
+    if worker.queue is not None:
+        worker().run()
+        return
+    invalid = [p for p in args.partitions if not 0 <= p < SENSOR_PARTITIONS]
+    if invalid:
+        sys.exit(f"Partitions must be between 0 and {SENSOR_PARTITIONS - 1}, got {invalid}")
+    # docker stop sends SIGTERM, stop the workers too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    supervise(args.sink, args.partitions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+from shared import codec
+from shared.database import SessionLocal
+from shared.redis_client import RedisClient
+from shared.sensors import models, repository, schemas
+
+# Usage: python -m consumer.migrate_latest_values
+# Moves the latest values from the old bare <sensor_id> string keys to the sensor:<id>:latest
+# hashes and writes the name of every sensor in postgres into its hash. Safe to run again.
+
+CHUNK_SIZE = 1000
+
+db = SessionLocal()
+redis = RedisClient(host="redis")
+
+sensors = db.query(models.Sensor.id, models.Sensor.name).all()
+moved = 0
+for start in range(0, len(sensors), CHUNK_SIZE):
+    chunk = sensors[start:start + CHUNK_SIZE]
+    old = redis.mget([sensor_id for sensor_id, _ in chunk])
+    pipeline = redis.pipeline()
+    for (sensor_id, name), value in zip(chunk, old):
+        mapping = {"name": name}
+        if value is not None:
+            mapping.update(codec.encode_latest(schemas.SensorData(**value)))
+            moved += 1
+        pipeline.hset(repository.LATEST_KEY.format(sensor_id), mapping=mapping)
+    pipeline.unlink(*[sensor_id for sensor_id, _ in chunk])
+    pipeline.execute()
+print(f"{len(sensors)} sensors named, {moved} latest values moved")
+
+db.close()
+redis.close()
@@ -0,0 +1,32 @@
+from shared.cassandra_client import CassandraClient
+from shared.sensors import repository
+from shared.timescale import Timescale
+
+# Usage: python -m consumer.rebuild_temperature_stats
+# Rebuilds sensor.temp_stats and sensor.temp_stats_daily from the full history in timescale.
+# Stop the cassandra consumer while it runs, readings it would process are still in sensor_data.
+
+DAILY_TEMPERATURES = """
+    SELECT sensor_id, time_bucket('1 day', last_seen)::date AS day,
+           MIN(temperature), MAX(temperature), SUM(temperature), COUNT(temperature)
+    FROM sensor_data
+    WHERE temperature IS NOT NULL
+    GROUP BY sensor_id, day
+"""
+
+ts = Timescale()
+cassandra = CassandraClient(hosts=["cassandra"])
+cassandra.execute("TRUNCATE sensor.temp_stats;")
+cassandra.execute("TRUNCATE sensor.temp_stats_daily;")
+
+totals = {}
+for rows in ts.stream(DAILY_TEMPERATURES):
+    daily = {(sensor_id, day): (min_temp, max_temp, sum_temp, count) for sensor_id, day, min_temp, max_temp, sum_temp, count in rows}
+    for (sensor_id, _), stats in daily.items():
+        repository.merge_stats(totals, sensor_id, stats)
+    repository.write_temperature_stats(cassandra, {}, daily)
+repository.write_temperature_stats(cassandra, totals, {})
+print(f"Rebuilt temperature stats of {len(totals)} sensors")
+
+ts.close()
+cassandra.close()
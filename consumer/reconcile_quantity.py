@@ -0,0 +1,37 @@
+import sys
+from collections import Counter
+
+from shared.cassandra_client import CassandraClient
+from shared.database import SessionLocal
+from shared.mongodb_client import MongoDBClient
+from shared.sensors import models, repository
+
+# Usage: python -m consumer.reconcile_quantity [--check]
+# Recounts the sensors of each type from postgres (types come from mongo, postgres doesn't have them)
+# and corrects sensor.quantity_by_type. With --check it only reports the drift.
+
+check_only = "--check" in sys.argv[1:]
+
+db = SessionLocal()
+mongodb = MongoDBClient(host="mongodb")
+cassandra = CassandraClient(hosts=["cassandra"])
+
+sensor_ids = [sensor_id for sensor_id, in db.query(models.Sensor.id)]
+expected = Counter(sensor["type"] for sensor in mongodb.get_sensors("id", sensor_ids))
+counters = repository.quantity_counters(cassandra.execute(repository.SELECT_QUANTITY))
+
+drift = 0
+for sensor_type in sorted(set(expected) | set(counters)):
+    delta = expected[sensor_type] - counters.get(sensor_type, 0)
+    if delta == 0:
+        continue
+    drift += 1
+    print(f"{sensor_type}: counter {counters.get(sensor_type, 0)}, postgres {expected[sensor_type]}")
+    if not check_only:
+        cassandra.execute(repository.UPDATE_QUANTITY, (delta, sensor_type))
+print(f"{drift} types drifted" + ("" if check_only or not drift else ", corrected"))
+
+db.close()
+mongodb.close()
+cassandra.close()
+sys.exit(1 if check_only and drift else 0)
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+from shared import codec
+from shared.bucket_cache import BucketCache, bucket_start, parse_time
+from shared.dedup import DedupCache
+from shared.elasticsearch_client import ElasticsearchClient
+from shared.publisher import INDEX_QUEUE, partition_queue
+from shared.subscriber import Subscriber
+from shared.redis_client import RedisClient
+from shared.timescale import Timescale
+from shared.cassandra_client import CassandraClient
+from shared.sensors import repository
+
+
+class Worker:
+    # Each sink consumes its own queues with its own prefetch and batching,
+    # configured through <NAME>_BATCH_SIZE, <NAME>_BATCH_WINDOW_MS and <NAME>_PREFETCH.
+    # Sizes count messages, a message from the batch endpoint carries many readings.
+    # A worker consumes one partition queue of its sink, unless it has a queue of its own.
+    # Messages it already wrote, redelivered after a crash or a timeout, are skipped by message id
+    name = None
+    queue = None
+    batch_size = 100
+    batch_window_ms = 500
+    deduplicate = True
+
+    def __init__(self, partition=0):
+        prefix = self.name.upper()
+        self.partition = partition
+        self.batch_size = int(os.environ.get(f"{prefix}_BATCH_SIZE", self.batch_size))
+        self.batch_window_ms = int(os.environ.get(f"{prefix}_BATCH_WINDOW_MS", self.batch_window_ms))
+        self.prefetch_count = int(os.environ.get(f"{prefix}_PREFETCH", self.batch_size))
+        self.subscriber = Subscriber(self.queue or partition_queue(self.name, partition))
+        self.dedup = DedupCache(f"{self.name}:{partition}", redis=RedisClient(host="redis")) if self.deduplicate else None
+
+    def run(self):
+        self.subscriber.subscribe_batch(self.flush, batch_size=self.batch_size, batch_window_ms=self.batch_window_ms, prefetch_count=self.prefetch_count)
+
+    def flush(self, messages):
+        received, ids = len(messages), None
+        if self.dedup is not None:
+            messages, ids = self.dedup.filter(messages)
+        readings = []
+        for _, body in messages:
+            try:
+                readings.extend(self.decode(body))
+            except (ValueError, KeyError) as e:
+                # Requeuing a malformed message would only fail again
+                print(f"[{self.name}:{self.partition}] Discarding invalid message:", e)
+        start = time.perf_counter()
+        if readings:
+            self.write(readings)
+        if ids:
+            # Only once written, a failed batch is requeued and must not be skipped
+            self.dedup.add(ids)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"[{self.name}:{self.partition}] Flushed batch of {len(readings)} readings in {elapsed_ms:.1f} ms, {received - len(messages)} duplicate messages skipped")
+
+    def decode(self, body):
+        # A message carries one reading or many (POST /sensors/data/batch)
+        return codec.decode_readings(body)
+
+    def write(self, readings):
+        raise NotImplementedError
+
+
+class TimescaleWorker(Worker):
+    # Full history, large batches make the multi-row upsert worth it
+    name = "timescale"
+    batch_size = 500
+    batch_window_ms = 1000
+
+    # Late readings in closed buckets are refreshed into the aggregates every refresh_interval_s by
+    # a thread with its own connection, one refresh per view over all the batches since the last
+    # one. A refresh lost in a crash is done by the aggregates' policies, which refresh every
+    # invalidated range
+    refresh_interval_s = 10
+
+    def __init__(self, partition=0):
+        super().__init__(partition)
+        self.refresh_interval_s = float(os.environ.get("TIMESCALE_REFRESH_INTERVAL_S", self.refresh_interval_s))
+        self.timescale = Timescale()
+        self.bucket_cache = BucketCache(RedisClient(host="redis"))
+        # view -> (start, end) and the (sensor_id, hour) to invalidate once refreshed
+        self._late_ranges = {}
+        self._late_hours = set()
+        self._late_lock = threading.Lock()
+        threading.Thread(target=self._refresh_late_buckets, name=f"{self.name}-{partition}-refresh", daemon=True).start()
+
+    def write(self, readings):
+        try:
+            repository.record_timescale_batch(ts=self.timescale, readings=readings)
+        except Exception:
+            # Leave the connection usable for the retry
+            self.timescale.rollback()
+            raise
+        # Only once the new rows are visible, or the API could cache the old aggregate again
+        self.bucket_cache.invalidate(readings)
+        ranges = repository.late_bucket_ranges(readings)
+        if ranges:
+            with self._late_lock:
+                repository.merge_ranges(self._late_ranges, ranges)
+                self._late_hours.update((sensor_id, bucket_start('hour', parse_time(data.last_seen))) for sensor_id, data in readings)
+
+    def _refresh_late_buckets(self):
+        timescale = None
+        while True:
+            time.sleep(self.refresh_interval_s)
+            with self._late_lock:
+                ranges, self._late_ranges = self._late_ranges, {}
+                hours, self._late_hours = self._late_hours, set()
+            if not ranges:
+                continue
+            try:
+                if timescale is None:
+                    timescale = Timescale()
+                repository.refresh_aggregates(timescale, ranges)
+                # The cached rows read before the refresh missed the late readings
+                self.bucket_cache.invalidate_times(list(hours))
+            except Exception as e:
+                print(f"[{self.name}:{self.partition}] Error refreshing late buckets, retrying:", e)
+                if timescale is not None:
+                    timescale.close()
+                timescale = None
+                with self._late_lock:
+                    repository.merge_ranges(self._late_ranges, ranges)
+                    self._late_hours.update(hours)
+
+
+class CassandraWorker(Worker):
+    name = "cassandra"
+    batch_size = 200
+    batch_window_ms = 500
+
+    def __init__(self, partition=0):
+        super().__init__(partition)
+        self.cassandra = CassandraClient(hosts=["cassandra"])
+
+    def write(self, readings):
+        repository.record_cassandra_batch(cassandra=self.cassandra, readings=readings)
+
+
+class RedisWorker(Worker):
+    # Latest value, small batches and a short window keep it fresh
+    name = "redis"
+    batch_size = 50
+    batch_window_ms = 50
+
+    def __init__(self, partition=0):
+        super().__init__(partition)
+        self.redis = RedisClient(host="redis")
+
+    def write(self, readings):
+        repository.record_redis_batch(redis=self.redis, readings=readings)
+
+
+class ElasticsearchWorker(Worker):
+    # Sensor documents, not readings. One bulk request per batch
+    name = "elasticsearch"
+    queue = INDEX_QUEUE
+    batch_size = 200
+    batch_window_ms = 200
+    # Indexing and deleting a document twice does no harm
+    deduplicate = False
+
+    def __init__(self, partition=0):
+        super().__init__(partition)
+        self.elastic = ElasticsearchClient(host="elasticsearch")
+
+    def decode(self, body):
+        message = codec.loads(body)
+        if message["action"] not in ("index", "delete"):
+            raise ValueError(f"Unknown action {message['action']}")
+        return [message]
+
+    def write(self, messages):
+        repository.record_elasticsearch_batch(elastic=self.elastic, messages=messages)
+
+
+WORKERS = {worker.name: worker for worker in (TimescaleWorker, CassandraWorker, RedisWorker, ElasticsearchWorker)}
@@ -0,0 +1,7 @@
+-- transactional: false
+
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_yearly;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_monthly;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_weekly;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_daily;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_hourly;
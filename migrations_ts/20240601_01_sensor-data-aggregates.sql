@@ -0,0 +1,67 @@
+-- Continuous aggregates read by GET /sensors/{id}/data, one per bucket size.
+-- materialized_only = false adds the rows newer than the last refresh (real-time aggregation),
+-- and each policy leaves the open bucket to it.
+-- depends: migrations_ts
+-- transactional: false
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_hourly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 hour', last_seen) AS bucket,
+       AVG(velocity) AS velocity,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 day', last_seen) AS bucket,
+       AVG(velocity) AS velocity,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_weekly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 week', last_seen) AS bucket,
+       AVG(velocity) AS velocity,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_monthly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 month', last_seen) AS bucket,
+       AVG(velocity) AS velocity,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_yearly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT sensor_id,
+       time_bucket(INTERVAL '1 year', last_seen) AS bucket,
+       AVG(velocity) AS velocity,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM sensor_data
+GROUP BY sensor_id, bucket
+WITH NO DATA;
+
+-- start_offset => NULL lets a refresh reach late readings in old buckets, only invalidated ranges are recomputed
+SELECT add_continuous_aggregate_policy('sensor_data_hourly', start_offset => NULL, end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '5 minutes', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('sensor_data_daily', start_offset => NULL, end_offset => INTERVAL '1 day', schedule_interval => INTERVAL '1 hour', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('sensor_data_weekly', start_offset => NULL, end_offset => INTERVAL '1 week', schedule_interval => INTERVAL '1 day', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('sensor_data_monthly', start_offset => NULL, end_offset => INTERVAL '1 month', schedule_interval => INTERVAL '1 day', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('sensor_data_yearly', start_offset => NULL, end_offset => INTERVAL '1 year', schedule_interval => INTERVAL '1 day', if_not_exists => true);
@@ -0,0 +1,223 @@
+import threading
+from datetime import datetime, timedelta
+
+from shared import codec
+from shared.redis_client import RedisClient
+
+BUCKETS = ('year', 'month', 'week', 'day', 'hour')
+
+# Same origin as timescale's time_bucket, weeks start on Monday
+WEEK_ORIGIN = datetime(2000, 1, 3)
+
+
+def parse_time(value) -> datetime:
+    # sensor_data.last_seen is a timestamp without time zone, postgres drops the offset the same way
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def bucket_start(bucket: str, time: datetime) -> datetime:
+    if bucket == 'hour':
+        return time.replace(minute=0, second=0, microsecond=0)
+    if bucket == 'day':
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        day = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        return day - timedelta(days=(day - WEEK_ORIGIN).days % 7)
+    if bucket == 'month':
+        return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'year':
+        return time.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError("Invalid bucket size")
+
+
+def next_bucket(bucket: str, start: datetime) -> datetime:
+    if bucket == 'hour':
+        return start + timedelta(hours=1)
+    if bucket == 'day':
+        return start + timedelta(days=1)
+    if bucket == 'week':
+        return start + timedelta(weeks=1)
+    if bucket == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    if bucket == 'year':
+        return start.replace(year=start.year + 1)
+    raise ValueError("Invalid bucket size")
+
+
+def bucket_starts(bucket: str, from_time: datetime, to_time: datetime, limit: int) -> list:
+    # Start of every bucket from the one containing from_time up to to_time, None if there are more than limit
+    starts = []
+    start = bucket_start(bucket, from_time)
+    while start <= to_time:
+        if len(starts) == limit:
+            return None
+        starts.append(start)
+        start = next_bucket(bucket, start)
+    return starts
+
+
+# Writes the rows only if the generation of the series is still the one get() read, returns
+# the number of cached series or -1 when an invalidation came in between.
+# KEYS: hash, generation, lru. ARGV: generation ("" if none), now, field, value, field, value...
+PUT_SCRIPT = """
+local generation = redis.call('GET', KEYS[2]) or ''
+if generation ~= ARGV[1] then
+    return -1
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[1])
+return redis.call('ZCARD', KEYS[3])
+"""
+
+
+class BucketCache:
+    # Aggregated rows of closed buckets, one redis hash per (sensor_id, bucket) with a field per
+    # bucket start. A closed bucket never changes unless a late reading lands in it, and the
+    # timescale consumer invalidates it when that happens. Empty closed buckets are cached too.
+    # At most max_series hashes are kept, the least recently read ones are evicted.
+    # Every invalidation bumps the generation of the series, get() returns the one it read and
+    # put() drops rows queried before an invalidation, which would otherwise stay cached stale.
+    LRU_KEY = "bucket_cache:lru"
+    # Only has to outlive the requests that read a generation
+    GENERATION_TTL_S = 3600
+
+    def __init__(self, redis: RedisClient, max_series=10000):
+        self.redis = redis
+        self.max_series = max_series
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(sensor_id: int, bucket: str) -> str:
+        return f"bucket_cache:{sensor_id}:{bucket}"
+
+    @staticmethod
+    def generation_key(sensor_id: int, bucket: str) -> str:
+        return f"bucket_cache:{sensor_id}:{bucket}:generation"
+
+    def get(self, sensor_id: int, bucket: str, starts: list) -> tuple:
+        # Returns {start: row or None} for the cached buckets, missing ones are left out, and
+        # the generation to pass to put()
+        if not starts:
+            return {}, None
+        values, generation, _ = self._get_pipeline(sensor_id, bucket, starts).execute()
+        return self._cached(starts, values), generation
+
+    def _get_pipeline(self, sensor_id: int, bucket: str, starts: list):
+        key = self.key(sensor_id, bucket)
+        pipeline = self.redis.pipeline()
+        pipeline.hmget(key, [start.isoformat() for start in starts])
+        pipeline.get(self.generation_key(sensor_id, bucket))
+        pipeline.zadd(self.LRU_KEY, {key: datetime.utcnow().timestamp()}, xx=True)
+        return pipeline
+
+    def _cached(self, starts: list, values: list) -> dict:
+        cached = {}
+        for start, value in zip(starts, values):
+            if value is not None:
+                cached[start] = codec.loads(value)
+        with self._lock:
+            self.hits += len(cached)
+            self.misses += len(starts) - len(cached)
+        return cached
+
+    def put(self, sensor_id: int, bucket: str, rows: dict, generation: bytes = None):
+        # rows is {start: row or None}, only pass closed buckets, generation is the one get()
+        # returned before the rows were queried
+        if not rows:
+            return
+        size = self._put_pipeline(sensor_id, bucket, rows, generation).execute()[-1]
+        if size > self.max_series:
+            self.evict(size - self.max_series)
+
+    def _put_pipeline(self, sensor_id: int, bucket: str, rows: dict, generation: bytes):
+        keys = [self.key(sensor_id, bucket), self.generation_key(sensor_id, bucket), self.LRU_KEY]
+        args = [generation or b"", datetime.utcnow().timestamp()]
+        for start, row in rows.items():
+            args += [start.isoformat(), codec.dumps(row)]
+        pipeline = self.redis.pipeline()
+        pipeline.eval(PUT_SCRIPT, len(keys), *keys, *args)
+        return pipeline
+
+    def evict(self, count: int):
+        evicted = self.redis.pipeline().zpopmin(self.LRU_KEY, count).execute()[0]
+        if evicted:
+            self.redis.pipeline().delete(*[key for key, _ in evicted]).execute()
+
+    def invalidate(self, readings: list):
+        # readings is a list of (sensor_id, SensorData), drops every bucket they fall in and bumps
+        # the generation of their series
+        self.invalidate_times([(sensor_id, parse_time(data.last_seen)) for sensor_id, data in readings])
+
+    def invalidate_times(self, times: list):
+        # times is a list of (sensor_id, datetime)
+        pipeline = self.redis.pipeline()
+        for sensor_id, time in times:
+            for bucket in BUCKETS:
+                pipeline.hdel(self.key(sensor_id, bucket), bucket_start(bucket, time).isoformat())
+        for sensor_id in {sensor_id for sensor_id, _ in times}:
+            for bucket in BUCKETS:
+                pipeline.incr(self.generation_key(sensor_id, bucket))
+                pipeline.expire(self.generation_key(sensor_id, bucket), self.GENERATION_TTL_S)
+        pipeline.execute()
+
+    def delete(self, sensor_id: int):
+        # Drops every series of a deleted sensor and bumps their generations, so a read still in
+        # flight doesn't cache them again
+        self._delete_pipeline(sensor_id).execute()
+
+    def _delete_pipeline(self, sensor_id: int):
+        pipeline = self.redis.pipeline()
+        keys = [self.key(sensor_id, bucket) for bucket in BUCKETS]
+        pipeline.unlink(*keys)
+        pipeline.zrem(self.LRU_KEY, *keys)
+        for bucket in BUCKETS:
+            pipeline.incr(self.generation_key(sensor_id, bucket))
+            pipeline.expire(self.generation_key(sensor_id, bucket), self.GENERATION_TTL_S)
+        return pipeline
+
+    def close(self):
+        # The redis client belongs to whoever passed it in
+        pass
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "max_series": self.max_series,
+            }
+
+
+class AsyncBucketCache(BucketCache):
+    # The same cache over an AsyncRedisClient, for the API. invalidate() stays with the consumer
+    async def get(self, sensor_id: int, bucket: str, starts: list) -> tuple:
+        if not starts:
+            return {}, None
+        values, generation, _ = await self._get_pipeline(sensor_id, bucket, starts).execute()
+        return self._cached(starts, values), generation
+
+    async def put(self, sensor_id: int, bucket: str, rows: dict, generation: bytes = None):
+        if not rows:
+            return
+        size = (await self._put_pipeline(sensor_id, bucket, rows, generation).execute())[-1]
+        if size > self.max_series:
+            await self.evict(size - self.max_series)
+
+    async def evict(self, count: int):
+        evicted = (await self.redis.pipeline().zpopmin(self.LRU_KEY, count).execute())[0]
+        if evicted:
+            await self.redis.pipeline().delete(*[key for key, _ in evicted]).execute()
+
+    async def delete(self, sensor_id: int):
+        await self._delete_pipeline(sensor_id).execute()
+
+    async def close(self):
+        pass
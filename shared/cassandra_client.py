@@ -1,18 +1,34 @@
-from cassandra.cluster import Cluster
-from cassandra.policies import RoundRobinPolicy
+import asyncio
+import threading
+
+# The driver is imported where it is used, importing cassandra.cluster takes ~85ms and the API
+# connects to Cassandra off the event loop, in parallel with the other backends
 
 class CassandraClient:
-    def __init__(self, hosts):
+    # The keyspace and the tables are created by python -m app.migrate, pass create_schema
+    # to create them from here instead
+    def __init__(self, hosts, create_schema=False):
+        from cassandra.cluster import Cluster
+        from cassandra.policies import RoundRobinPolicy
+
         lbp = RoundRobinPolicy()
 
         self.cluster = Cluster(hosts,protocol_version=4,load_balancing_policy=lbp)
         self.session = self.cluster.connect()
 
-        self.session.execute("CREATE KEYSPACE IF NOT EXISTS sensor WITH REPLICATION = { 'class': 'SimpleStrategy', 'replication_factor': 1};")
+        if create_schema:
+            self.create_schema()
         self.session.execute("USE sensor;")
-        self.session.execute("CREATE TABLE IF NOT EXISTS temp_values(sensor_id INT, temp FLOAT, PRIMARY KEY(sensor_id, temp));")
-        self.session.execute("CREATE TABLE IF NOT EXISTS quantity(sensor_id INT, sensor_type text, PRIMARY KEY(sensor_type, sensor_id));")
-        self.session.execute("CREATE TABLE IF NOT EXISTS low_bat(sensor_id INT, battery FLOAT, PRIMARY KEY(battery, sensor_id));")
+
+        # query string -> PreparedStatement, so the server parses every statement only once
+        self._prepared = {}
+        self._prepared_lock = threading.Lock()
+
+    def create_schema(self):
+        self.session.execute("CREATE KEYSPACE IF NOT EXISTS sensor WITH REPLICATION = { 'class': 'SimpleStrategy', 'replication_factor': 1};")
+        self.session.execute("CREATE TABLE IF NOT EXISTS sensor.temp_stats(sensor_id INT PRIMARY KEY, min_temp DOUBLE, max_temp DOUBLE, sum_temp DOUBLE, count BIGINT);")
+        self.session.execute("CREATE TABLE IF NOT EXISTS sensor.temp_stats_daily(sensor_id INT, day DATE, min_temp DOUBLE, max_temp DOUBLE, sum_temp DOUBLE, count BIGINT, PRIMARY KEY(sensor_id, day));")
+        self.session.execute("CREATE TABLE IF NOT EXISTS sensor.quantity_by_type(sensor_type text PRIMARY KEY, quantity counter);")
 
     def get_session(self):
         return self.session
@@ -20,5 +36,74 @@ class CassandraClient:
     def close(self):
         self.cluster.shutdown()
 
-    def execute(self, query):
-        return self.get_session().execute(query)
\ No newline at end of file
+    def prepare(self, query):
+        statement = self._prepared.get(query)
+        if statement is None:
+            with self._prepared_lock:
+                statement = self._prepared.get(query)
+                if statement is None:
+                    statement = self.get_session().prepare(query)
+                    self._prepared[query] = statement
+        return statement
+
+    def execute(self, query, params=()):
+        # Queries go through the prepared statement cache, pass values as ? bind markers
+        return self.get_session().execute(self.prepare(query), params)
+
+    def execute_async(self, query, params=()):
+        # Returns a ResponseFuture, call .result() to wait for the rows
+        return self.get_session().execute_async(self.prepare(query), params)
+
+    def execute_bulk(self, statements, concurrency=50):
+        # statements is a list of (query, params), at most concurrency of them are in flight
+        from cassandra.concurrent import execute_concurrent
+
+        if not statements:
+            return []
+        prepared = [(self.prepare(query), params) for query, params in statements]
+        return execute_concurrent(self.get_session(), prepared, concurrency=concurrency, raise_on_first_error=True)
+
+    def execute_concurrent(self, query, params, concurrency=50):
+        # Runs the same statement for every parameter tuple
+        return self.execute_bulk([(query, p) for p in params], concurrency=concurrency)
+
+
+class AsyncCassandraClient:
+    # asyncio wrapper over CassandraClient. The driver completes its futures on its own
+    # thread, the callbacks hand the rows back to the event loop
+    def __init__(self, cassandra: CassandraClient):
+        self.cassandra = cassandra
+
+    async def close(self):
+        self.cassandra.close()
+
+    def get_session(self):
+        return self.cassandra.get_session()
+
+    async def execute(self, query, params=()):
+        # Returns every row, following the pages in the driver's thread
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        rows = []
+        response = self.cassandra.execute_async(query, params)
+
+        def resolve(result=None, error=None):
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def on_page(page):
+            rows.extend(page)
+            if response.has_more_pages:
+                response.start_fetching_next_page()
+            else:
+                loop.call_soon_threadsafe(resolve, rows)
+
+        def on_error(error):
+            loop.call_soon_threadsafe(resolve, None, error)
+
+        response.add_callbacks(on_page, on_error)
+        return await future
@@ -0,0 +1,107 @@
+import json
+
+import msgpack
+import orjson
+from fastapi.responses import JSONResponse
+
+from shared.sensors import schemas
+
+# Encoding of everything the services exchange: readings and sensor documents on RabbitMQ,
+# values in Redis and the API's JSON. Binary payloads start with a version byte, so the format
+# can change while old messages are still queued. Payloads starting with '{' or '[' are the
+# JSON written before, they are still decoded.
+
+VERSION = 1
+_HEADER = bytes([VERSION])
+_LEGACY = (ord("{"), ord("["))
+
+# Layout of a reading in version 1, positional so the field names are not sent every time
+READING_FIELDS = ("velocity", "temperature", "humidity", "battery_level", "last_seen")
+
+
+def _payload(data: bytes):
+    if not data:
+        raise ValueError("Empty payload")
+    if data[0] in _LEGACY:
+        return json.loads(data), True
+    if data[0] != VERSION:
+        raise ValueError(f"Unknown codec version {data[0]}")
+    return msgpack.unpackb(data[1:]), False
+
+
+def dumps(value) -> bytes:
+    return _HEADER + msgpack.packb(value)
+
+
+def loads(data: bytes):
+    return _payload(data)[0]
+
+
+def encode_readings(readings: list) -> bytes:
+    # readings are (sensor_id, SensorData), one message for all of them
+    return _HEADER + msgpack.packb([[sensor_id, data.velocity, data.temperature, data.humidity, data.battery_level, data.last_seen] for sensor_id, data in readings])
+
+
+def decode_readings(data: bytes) -> list:
+    # Returns [(sensor_id, SensorData)], raises ValueError or KeyError on a malformed message
+    payload, legacy = _payload(data)
+    if legacy:
+        messages = payload if isinstance(payload, list) else [payload]
+        return [(message.pop("sensor_id"), schemas.SensorData(**message)) for message in messages]
+    if not isinstance(payload, list):
+        raise ValueError("Readings must be a list")
+    readings = []
+    for item in payload:
+        if not isinstance(item, list) or len(item) != len(READING_FIELDS) + 1:
+            raise ValueError(f"Malformed reading {item!r}")
+        # Validated by the API before it was published
+        readings.append((item[0], schemas.SensorData.construct(**dict(zip(READING_FIELDS, item[1:])))))
+    return readings
+
+
+# Fields of a sensor's latest-value hash in redis, the name is written when the sensor is created
+LATEST_FIELDS = ("name", "velocity", "temperature", "humidity", "battery_level", "last_seen")
+
+
+def encode_latest(data) -> dict:
+    # Hash fields of a reading, redis stores strings and a missing value is empty
+    return {
+        "velocity": "" if data.velocity is None else repr(data.velocity),
+        "temperature": "" if data.temperature is None else repr(data.temperature),
+        "humidity": "" if data.humidity is None else repr(data.humidity),
+        "battery_level": repr(data.battery_level),
+        "last_seen": data.last_seen,
+    }
+
+
+def decode_latest(values: list):
+    # values are the HMGET of LATEST_FIELDS, None when the hash has no name (no such sensor)
+    name, velocity, temperature, humidity, battery_level, last_seen = values
+    if name is None:
+        return None
+
+    def number(value):
+        return float(value) if value else None
+    return {
+        "name": name.decode(),
+        "velocity": number(velocity),
+        "temperature": number(temperature),
+        "humidity": number(humidity),
+        "battery_level": number(battery_level),
+        "last_seen": last_seen.decode() if last_seen is not None else None,
+    }
+
+
+def json_dumps(value) -> bytes:
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+
+def json_loads(data):
+    # orjson.JSONDecodeError is a ValueError
+    return orjson.loads(data)
+
+
+class ORJSONResponse(JSONResponse):
+    # Default response class of the API
+    def render(self, content) -> bytes:
+        return json_dumps(content)
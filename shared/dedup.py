@@ -0,0 +1,86 @@
+import os
+import time
+from collections import OrderedDict
+
+# Message ids remembered per consumer process, and for how long. Redeliveries come soon after a
+# crash or a consumer timeout, the ttl only has to cover that
+DEDUP_SIZE = int(os.environ.get("DEDUP_SIZE", 200000))
+DEDUP_TTL_S = int(os.environ.get("DEDUP_TTL_S", 600))
+# Also keep the ids in redis, so a restarted consumer skips what its previous run wrote
+DEDUP_REDIS = os.environ.get("DEDUP_REDIS") == "1"
+# Hash of "<sink>:<partition>" -> duplicates skipped, reported by GET /metrics
+DEDUP_HITS_KEY = "dedup:hits"
+
+
+class DedupCache:
+    # Ids of the messages a consumer already wrote, at most max_size of them for ttl seconds,
+    # oldest out first. With persist the ids also go to one redis set per ttl window
+    # (dedup:<name>:<window>), a lookup checks the current window and the previous one.
+    # Only used from the consumer's thread.
+    def __init__(self, name: str, redis=None, max_size: int = DEDUP_SIZE, ttl: int = DEDUP_TTL_S, persist: bool = DEDUP_REDIS):
+        self.name = name
+        self.redis = redis
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist and redis is not None
+        self.hits = 0
+        # id -> expiry, in insertion order, which is also expiry order
+        self._ids = OrderedDict()
+
+    def _windows(self):
+        window = int(time.time() // self.ttl)
+        return f"dedup:{self.name}:{window}", f"dedup:{self.name}:{window - 1}"
+
+    def _expire(self, now):
+        while self._ids:
+            expiry = next(iter(self._ids.values()))
+            if expiry > now and len(self._ids) <= self.max_size:
+                break
+            self._ids.popitem(last=False)
+
+    def filter(self, messages: list) -> tuple:
+        # messages are (message_id, body). Returns the ones not seen yet, repeats within messages
+        # included, and their ids. Pass the ids to add() once they are written. The publisher gives
+        # every message its own id, so a reading posted again is a new message and is not skipped.
+        # Messages without an id are never skipped
+        now = time.monotonic()
+        self._expire(now)
+        fresh, ids, batch = [], [], set()
+        for message in messages:
+            key = message[0]
+            if key is None:
+                fresh.append(message)
+                continue
+            if key in self._ids or key in batch:
+                continue
+            batch.add(key)
+            fresh.append(message)
+            ids.append(key)
+
+        if self.persist and ids:
+            pipeline = self.redis.pipeline()
+            for window in self._windows():
+                pipeline.smismember(window, ids)
+            current, previous = pipeline.execute()
+            seen = {key for key, a, b in zip(ids, current, previous) if a or b}
+            fresh = [message for message in fresh if message[0] not in seen]
+            ids = [key for key in ids if key not in seen]
+
+        hits = len(messages) - len(fresh)
+        if hits:
+            self.hits += hits
+            if self.redis is not None:
+                self.redis.pipeline().hincrby(DEDUP_HITS_KEY, self.name, hits).execute()
+        return fresh, ids
+
+    def add(self, ids: list):
+        expiry = time.monotonic() + self.ttl
+        for key in ids:
+            self._ids[key] = expiry
+        self._expire(time.monotonic())
+        if self.persist and ids:
+            window = self._windows()[0]
+            pipeline = self.redis.pipeline()
+            pipeline.sadd(window, *ids)
+            pipeline.expire(window, 2 * self.ttl)
+            pipeline.execute()
@@ -1,26 +1,42 @@
-from elasticsearch import Elasticsearch
 import time
 
+# The elasticsearch package is imported where it is used, it is the slowest import of the API
+# (~350ms) and the registry imports it off the event loop while the other backends connect
+
+SENSORS_MAPPING = {
+    "properties":{
+        "id":{"type":"integer"},
+        "name":{"type":"keyword"},
+        "type":{"type":"keyword"},
+        "description":{"type":"text"},
+        "latitude":{"type":"float"},
+        "longitude":{"type":"float"},
+        "mac_address":{"type":"keyword"},
+        "manufacturer":{"type":"keyword"},
+        "model":{"type":"keyword"},
+        "serie_number":{"type":"keyword"},
+        "firmware_version":{"type":"keyword"}
+    }
+}
+
 class ElasticsearchClient:
-    def __init__(self, host="localhost", port="9200"):
+    def __init__(self, host="localhost", port="9200", max_connections=10):
         self.host = host
         self.port = port
-        self.client = Elasticsearch(["http://"+self.host+":"+self.port])
+        self.max_connections = max_connections
+        from elasticsearch import Elasticsearch
+        self.client = Elasticsearch(["http://"+self.host+":"+self.port], connections_per_node=max_connections)
 
         while not self.ping():
             print("Waiting for Elasticsearch to start...")
             time.sleep(1)
 
+    def ensure_index(self):
+        # Creates the sensors index with its mapping, run by python -m app.migrate. An index
+        # created before a field was in the mapping gets it added
         if not self.client.indices.exists(index="sensors"):
             self.create_index(index_name="sensors")
-            mapping = {
-                "properties":{
-                    "name":{"type":"keyword"},
-                    "type":{"type":"keyword"},
-                    "description":{"type":"text"}
-                }
-            }
-            self.create_mapping(index_name="sensors",mapping=mapping)
+        self.create_mapping(index_name="sensors",mapping=SENSORS_MAPPING)
 
     def ping(self):
         return self.client.ping()
@@ -45,10 +61,30 @@ class ElasticsearchClient:
     def search(self, index_name, query):
         return self.client.search(index=index_name, body=query)
     
+    def delete_by_query(self, index_name, query):
+        return self.client.delete_by_query(index=index_name, query=query, refresh=True)
+
     def index_document(self, index_name, document):
         return self.client.index(index=index_name, document=document)
-    
 
-    
-    
-    
+    def bulk(self, actions):
+        # actions are bulk API actions ({"_op_type", "_index", "_id", ...}), deleting a missing document is not an error
+        from elasticsearch import helpers
+        return helpers.bulk(self.client, actions, ignore_status=(404,))
+
+
+class AsyncElasticsearchClient:
+    # AsyncElasticsearch version of ElasticsearchClient for the API, the index must exist already
+    def __init__(self, host="localhost", port="9200", max_connections=10):
+        from elasticsearch import AsyncElasticsearch
+        self.max_connections = max_connections
+        self.client = AsyncElasticsearch(["http://"+host+":"+port], connections_per_node=max_connections)
+
+    async def ping(self):
+        return await self.client.ping()
+
+    async def close(self):
+        await self.client.close()
+
+    async def search(self, index_name, query):
+        return await self.client.search(index=index_name, body=query)
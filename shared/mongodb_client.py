@@ -1,10 +1,78 @@
-from pymongo import MongoClient
+import threading
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import GEOSPHERE, MongoClient, monitoring
+
+# The GeoJSON location is only there for the 2dsphere index, sensors keep latitude/longitude
+PROJECTION = {"_id": 0, "location": 0}
+
+
+class CheckoutTimer(monitoring.ConnectionPoolListener):
+    # Pool events fire in the thread doing the checkout, so a thread local is enough to time it
+    def __init__(self, stats):
+        self.stats = stats
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        start = getattr(self._local, "start", None)
+        if start is not None:
+            self.stats.record(time.perf_counter() - start)
+            self._local.start = None
+
+    def connection_check_out_failed(self, event):
+        self._local.start = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def near_pipeline(longitude, latitude, radius, limit):
+    # Sensors within radius metres, closest first, using the 2dsphere index
+    return [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [longitude, latitude]},
+            "key": "location",
+            "distanceField": "distance",
+            "maxDistance": radius,
+            "spherical": True,
+        }},
+        {"$sort": {"distance": 1, "id": 1}},
+        {"$limit": limit},
+        {"$project": PROJECTION},
+    ]
+
 
 class MongoDBClient:
-    def __init__(self, host="localhost", port=27017):
+    def __init__(self, host="localhost", port=27017, max_pool_size=100, stats=None):
         self.host = host
         self.port = port
-        self.client = MongoClient(host, port)
+        listeners = [CheckoutTimer(stats)] if stats is not None else []
+        self.client = MongoClient(host, port, maxPoolSize=max_pool_size, event_listeners=listeners)
         self.database = self.client["MongoDB_"]
         self.collection = self.database["sensors"]
 
@@ -32,12 +100,60 @@ class MongoDBClient:
         return self.collection.delete_one(query)
     
     def getDocuments(self, query):
-        return self.collection.find(query, {'_id':0})
+        return self.collection.find(query, PROJECTION)
     
     def set_sensor(self,document):
         return self.collection.insert_one(document)
     
     def get_sensor(self,query):
-        return self.collection.find_one(query, {"_id":0})
+        return self.collection.find_one(query, PROJECTION)
+
+    def ensure_indexes(self):
+        # Sensors stored before the GeoJSON location existed get one built from latitude/longitude
+        self.collection.update_many({"location": {"$exists": False}}, [{"$set": {"location": {"type": "Point", "coordinates": ["$longitude", "$latitude"]}}}])
+        self.collection.create_index([("location", GEOSPHERE)])
+        self.collection.create_index("id")
+        self.collection.create_index("name")
+
+    def near(self, longitude, latitude, radius, limit):
+        return list(self.collection.aggregate(near_pipeline(longitude, latitude, radius, limit)))
+
+    def get_sensors(self, field, values):
+        # Every sensor whose field is one of values, in a single $in query
+        if not values:
+            return []
+        return list(self.collection.find({field: {"$in": list(values)}}, PROJECTION))
+
+
+class AsyncMongoDBClient:
+    # motor version of MongoDBClient for the API, same database and collection
+    def __init__(self, host="localhost", port=27017, max_pool_size=100, stats=None):
+        listeners = [CheckoutTimer(stats)] if stats is not None else []
+        self.client = AsyncIOMotorClient(host, port, maxPoolSize=max_pool_size, event_listeners=listeners)
+        self.collection = self.client["MongoDB_"]["sensors"]
+
+    async def close(self):
+        self.client.close()
+
+    async def ping(self):
+        return await self.client.admin.command('ping')
+
+    async def set_sensor(self, document):
+        return await self.collection.insert_one(document)
+
+    async def get_sensor(self, query):
+        return await self.collection.find_one(query, PROJECTION)
+
+    async def delete(self, query):
+        return await self.collection.delete_one(query)
+
+    async def get_sensors(self, field, values):
+        if not values:
+            return []
+        return await self.collection.find({field: {"$in": list(values)}}, PROJECTION).to_list(length=None)
 
+    async def get_all_sensors(self, limit):
+        return await self.collection.find({}, PROJECTION).limit(limit).to_list(length=None)
 
+    async def near(self, longitude, latitude, radius, limit):
+        return await self.collection.aggregate(near_pipeline(longitude, latitude, radius, limit)).to_list(length=None)
@@ -1,34 +1,163 @@
 import redis
-import json
+import redis.asyncio
+import time
+
+from shared import codec
+
+# Keys per SCAN page and per UNLINK
+SCAN_COUNT = 1000
+
+
+class TimedConnectionPool(redis.BlockingConnectionPool):
+    # Blocks when max_connections are in use and reports how long each checkout waited
+    def __init__(self, stats=None, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        connection = super().get_connection(command_name, *keys, **options)
+        if self.stats is not None:
+            self.stats.record(time.perf_counter() - start)
+        return connection
+
 
 class RedisClient:
-    def __init__(self, host='localhost', port=6379, db=0):
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=None, stats=None):
         self._host = host
         self._port = port
         self._db = db
-        self._client = redis.Redis(host=self._host, port=self._port, db=self._db)
+        if max_connections:
+            pool = TimedConnectionPool(stats=stats, host=self._host, port=self._port, db=self._db, max_connections=max_connections)
+            self._client = redis.Redis(connection_pool=pool)
+        else:
+            self._client = redis.Redis(host=self._host, port=self._port, db=self._db)
     
     def close(self):
         self._client.close()
+        self._client.connection_pool.disconnect()
 
     def ping(self):
         return self._client.ping()
     
     def get(self, key):
         data = self._client.get(key)
-        return json.loads(data)
+        return codec.loads(data)
     
+    def mget(self, keys):
+        # Values of all the keys in a single round trip, None where a key is missing
+        if not keys:
+            return []
+        return [codec.loads(data) if data is not None else None for data in self._client.mget(keys)]
+
     def set(self, key, value):
-        value2 = json.dumps(value)
-        return self._client.set(key, value2)
+        return self._client.set(key, codec.dumps(value))
     
+    def pipeline(self):
+        # Commands are buffered and sent in a single round trip on execute()
+        return self._client.pipeline(transaction=False)
+
+    def hmget_many(self, keys, fields):
+        # The fields of every hash in a single round trip, a list of values per key
+        if not keys:
+            return []
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.hmget(key, fields)
+        return pipeline.execute()
+
+    def hset_many(self, values, pipeline=None):
+        # values is {key: {field: value}}, written in a single round trip or queued on pipeline
+        own_pipeline = pipeline is None
+        if own_pipeline:
+            pipeline = self.pipeline()
+        for key, mapping in values.items():
+            pipeline.hset(key, mapping=mapping)
+        if own_pipeline:
+            return pipeline.execute()
+
+    def range_by_score(self, key, max_score, offset, count):
+        # [(member, score)] with score <= max_score, lowest first
+        return self._client.zrangebyscore(key, "-inf", max_score, start=offset, num=count, withscores=True)
+
+    def geoadd(self, key, longitude, latitude, member):
+        return self._client.geoadd(key, [longitude, latitude, member])
+
+    def geosearch(self, key, longitude, latitude, radius, count):
+        # [(member, distance in metres)] closest first
+        return self._client.geosearch(key, longitude=longitude, latitude=latitude, radius=radius, unit="m", sort="ASC", count=count, withdist=True)
+
     def delete(self, key):
         return self._client.delete(key)
     
     def keys(self, pattern):
-        return self._client.keys(pattern)
-    
+        # SCAN instead of KEYS, which blocks the server while it walks the whole keyspace
+        return list(self._client.scan_iter(match=pattern, count=SCAN_COUNT))
+
+    def unlink_matching(self, pattern):
+        # Frees the keys in the background, one UNLINK per SCAN page. Returns how many went
+        removed = 0
+        batch = []
+        for key in self._client.scan_iter(match=pattern, count=SCAN_COUNT):
+            batch.append(key)
+            if len(batch) >= SCAN_COUNT:
+                removed += self._client.unlink(*batch)
+                batch = []
+        if batch:
+            removed += self._client.unlink(*batch)
+        return removed
+
     def clearAll(self):
-        for key in self._client.keys("*"):
-            self._client.delete(key)
-    
+        return self.unlink_matching("*")
+
+
+class AsyncTimedConnectionPool(redis.asyncio.BlockingConnectionPool):
+    # Same as TimedConnectionPool for the asyncio client
+    def __init__(self, stats=None, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        connection = await super().get_connection(command_name, *keys, **options)
+        if self.stats is not None:
+            self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+class AsyncRedisClient:
+    # redis.asyncio version of RedisClient for the API, same keys and encoding
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=None, stats=None):
+        if max_connections:
+            pool = AsyncTimedConnectionPool(stats=stats, host=host, port=port, db=db, max_connections=max_connections)
+            self._client = redis.asyncio.Redis(connection_pool=pool)
+        else:
+            self._client = redis.asyncio.Redis(host=host, port=port, db=db)
+
+    async def close(self):
+        await self._client.close()
+        await self._client.connection_pool.disconnect()
+
+    async def ping(self):
+        return await self._client.ping()
+
+    def pipeline(self):
+        # Commands are buffered and sent in a single round trip on await execute()
+        return self._client.pipeline(transaction=False)
+
+    async def hmget_many(self, keys, fields):
+        if not keys:
+            return []
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.hmget(key, fields)
+        return await pipeline.execute()
+
+    async def hgetall(self, key):
+        return await self._client.hgetall(key)
+
+    async def range_by_score(self, key, max_score, offset, count):
+        return await self._client.zrangebyscore(key, "-inf", max_score, start=offset, num=count, withscores=True)
+
+    async def geosearch(self, key, longitude, latitude, radius, count):
+        return await self._client.geosearch(key, longitude=longitude, latitude=latitude, radius=radius, unit="m", sort="ASC", count=count, withdist=True)
@@ -0,0 +1,256 @@
+import asyncio
+import functools
+import importlib
+import os
+import threading
+import time
+
+from sqlalchemy.sql import text
+
+from shared.bucket_cache import AsyncBucketCache
+from shared.cassandra_client import AsyncCassandraClient, CassandraClient
+from shared.database import async_engine
+from shared.elasticsearch_client import AsyncElasticsearchClient
+from shared.mongodb_client import AsyncMongoDBClient
+from shared.publisher import AsyncPublisher
+from shared.redis_client import AsyncRedisClient
+from shared.sensor_cache import SensorCache
+from shared.timescale import AsyncTimescalePool
+
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 40))
+BUCKET_CACHE_MAX_SERIES = int(os.environ.get("BUCKET_CACHE_MAX_SERIES", 10000))
+# Seconds every backend gets to connect at startup, the ones that don't are retried in the
+# background with a backoff of up to STARTUP_RETRY_MAX_S
+STARTUP_TIMEOUT_S = float(os.environ.get("STARTUP_TIMEOUT_S", 10))
+STARTUP_RETRY_MAX_S = 10
+
+
+class PoolStats:
+    # How long callers waited to get a connection out of a pool
+    def __init__(self, size):
+        self.size = size
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait):
+        with self._lock:
+            self.acquired += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self):
+        with self._lock:
+            wait_avg = self.wait_total / self.acquired if self.acquired else 0.0
+            return {
+                "size": self.size,
+                "acquired": self.acquired,
+                "wait_avg_ms": round(wait_avg * 1000, 3),
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+class BackendUnavailable(RuntimeError):
+    # A request needs a backend that is not connected yet, the API answers 503
+    pass
+
+
+class ClientRegistry:
+    # One pooled asyncio client per backend for the whole API process. start() connects to
+    # every backend in parallel on the event loop that serves the requests, each within timeout
+    # seconds. A backend that fails or times out is retried in the background, until then
+    # ready() is False and the requests that need it get BackendUnavailable. The schemas are
+    # not touched here, that is python -m app.migrate.
+    # startup holds the status and the seconds of the last attempt of every backend.
+    def __init__(self, pool_size=POOL_SIZE, timeout=STARTUP_TIMEOUT_S, steps=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.stats = {
+            "redis": PoolStats(pool_size),
+            "mongodb": PoolStats(pool_size),
+            "timescale": PoolStats(pool_size),
+        }
+        # backend -> coroutine function returning the clients it adds
+        self.steps = steps if steps is not None else {
+            "redis": self._start_redis,
+            "postgres": self._start_postgres,
+            "mongodb": self._start_mongodb,
+            "sensor_cache": self._start_sensor_cache,
+            "elasticsearch": self._start_elasticsearch,
+            "cassandra": self._start_cassandra,
+            "timescale": self._start_timescale,
+            "publisher": self._start_publisher,
+        }
+        self.startup = {}
+        self.started_in = None
+        self._clients = {}
+        self._connected = {}
+        self._retries = []
+
+    def _get(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            raise BackendUnavailable(f"The {name} client is not connected yet")
+        return client
+
+    def redis(self) -> AsyncRedisClient:
+        return self._get("redis")
+
+    def mongodb(self) -> AsyncMongoDBClient:
+        return self._get("mongodb")
+
+    def elasticsearch(self) -> AsyncElasticsearchClient:
+        return self._get("elasticsearch")
+
+    def cassandra(self) -> AsyncCassandraClient:
+        return self._get("cassandra")
+
+    def timescale(self) -> AsyncTimescalePool:
+        return self._get("timescale")
+
+    def publisher(self) -> AsyncPublisher:
+        return self._get("publisher")
+
+    def bucket_cache(self) -> AsyncBucketCache:
+        return self._get("bucket_cache")
+
+    def sensor_cache(self) -> SensorCache:
+        return self._get("sensor_cache")
+
+    async def _start_redis(self):
+        redis = AsyncRedisClient(host="redis", max_connections=self.pool_size, stats=self.stats["redis"])
+        try:
+            await redis.ping()
+        except BaseException:
+            await redis.close()
+            raise
+        return {"redis": redis, "bucket_cache": AsyncBucketCache(redis, max_series=BUCKET_CACHE_MAX_SERIES)}
+
+    async def _start_postgres(self):
+        # Sessions are opened per request, this only checks that the database answers
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return {}
+
+    async def _start_mongodb(self):
+        mongodb = AsyncMongoDBClient(host="mongodb", max_pool_size=self.pool_size, stats=self.stats["mongodb"])
+        try:
+            await mongodb.ping()
+        except BaseException:
+            await mongodb.close()
+            raise
+        return {"mongodb": mongodb}
+
+    async def _start_sensor_cache(self):
+        await self._connected["mongodb"].wait()
+        sensor_cache = SensorCache(self._clients["mongodb"])
+        try:
+            await sensor_cache.start()
+        except BaseException:
+            await sensor_cache.close()
+            raise
+        return {"sensor_cache": sensor_cache}
+
+    async def _start_elasticsearch(self):
+        # The driver is the slowest import of the API, it is imported off the event loop
+        await asyncio.to_thread(importlib.import_module, "elasticsearch")
+        elasticsearch = AsyncElasticsearchClient(host="elasticsearch", max_connections=self.pool_size)
+        try:
+            if not await elasticsearch.ping():
+                raise ConnectionError("Elasticsearch did not answer the ping")
+        except BaseException:
+            await elasticsearch.close()
+            raise
+        return {"elasticsearch": elasticsearch}
+
+    async def _start_cassandra(self):
+        # The Cassandra driver is imported and connects synchronously, off the event loop. The
+        # timeout can't stop the thread, a client that connects after it is shut down, or every
+        # retry would leave a connected cluster behind
+        loop = asyncio.get_running_loop()
+        connecting = loop.run_in_executor(None, functools.partial(CassandraClient, hosts=["cassandra"]))
+
+        def close_late(future):
+            if not future.cancelled() and future.exception() is None:
+                loop.run_in_executor(None, future.result().close)
+
+        try:
+            cassandra = await asyncio.shield(connecting)
+        except asyncio.CancelledError:
+            connecting.add_done_callback(close_late)
+            raise
+        return {"cassandra": AsyncCassandraClient(cassandra)}
+
+    async def _start_timescale(self):
+        timescale = AsyncTimescalePool(maxconn=self.pool_size, stats=self.stats["timescale"])
+        await timescale.start()
+        return {"timescale": timescale}
+
+    async def _start_publisher(self):
+        # Connects to RabbitMQ in the background and spills to disk meanwhile, so it never
+        # keeps the API from being ready
+        publisher = AsyncPublisher()
+        await publisher.start()
+        return {"publisher": publisher}
+
+    async def _attempt(self, name):
+        start = time.perf_counter()
+        self.startup[name] = {"status": "starting"}
+        try:
+            clients = await asyncio.wait_for(self.steps[name](), self.timeout)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            self.startup[name] = {"status": "failed", "seconds": round(time.perf_counter() - start, 3), "error": error}
+            print(f"[{name}] Not connected after {time.perf_counter() - start:.2f}s:", error)
+            return False
+        self._clients.update(clients)
+        self._connected[name].set()
+        self.startup[name] = {"status": "ready", "seconds": round(time.perf_counter() - start, 3)}
+        return True
+
+    async def _retry(self, name):
+        delay = 0.5
+        while True:
+            await asyncio.sleep(delay)
+            if await self._attempt(name):
+                return
+            delay = min(delay * 2, STARTUP_RETRY_MAX_S)
+
+    async def start(self):
+        start = time.perf_counter()
+        self._connected = {name: asyncio.Event() for name in self.steps}
+        results = await asyncio.gather(*(self._attempt(name) for name in self.steps))
+        for name, connected in zip(self.steps, results):
+            if not connected:
+                self._retries.append(asyncio.create_task(self._retry(name)))
+        self.started_in = round(time.perf_counter() - start, 3)
+
+    def ready(self):
+        return bool(self.steps) and all(self.startup.get(name, {}).get("status") == "ready" for name in self.steps)
+
+    async def close(self):
+        retries, self._retries = self._retries, []
+        for task in retries:
+            task.cancel()
+        await asyncio.gather(*retries, return_exceptions=True)
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.close()
+        await async_engine.dispose()
+
+    def metrics(self):
+        metrics = {name: stats.as_dict() for name, stats in self.stats.items()}
+        metrics["postgres"] = {"size": async_engine.pool.size(), "checked_out": async_engine.pool.checkedout(), "overflow": async_engine.pool.overflow()}
+        if "elasticsearch" in self._clients:
+            metrics["elasticsearch"] = {"size": self._clients["elasticsearch"].max_connections}
+        if "cassandra" in self._clients:
+            pools = self._clients["cassandra"].get_session().get_pool_state().values()
+            metrics["cassandra"] = {
+                "size": sum(pool["open_count"] for pool in pools),
+                "in_flight": sum(sum(pool["in_flights"]) for pool in pools),
+            }
+        return metrics
+
+
+registry = ClientRegistry()
@@ -0,0 +1,69 @@
+import csv
+import io
+from datetime import datetime
+
+from shared import codec
+
+# Serializers for GET /sensors/{id}/data/export. Each one turns an async iterator of row chunks
+# into an async iterator of bytes, so only one chunk is in memory at a time.
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+TIME_COLUMNS = ("last_seen", "bucket")
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+async def ndjson(columns, chunks):
+    async for rows in chunks:
+        # orjson writes datetimes as isoformat itself
+        yield b"".join(codec.json_dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+async def csv_(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for rows in chunks:
+        writer.writerows([[_value(value) for value in row] for row in rows])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Header of an empty export
+        yield buffer.getvalue().encode()
+
+
+def arrow_available():
+    # pyarrow has no wheels for the alpine image, arrow exports only work where it is installed
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+async def arrow(columns, chunks):
+    # Arrow IPC stream, one record batch per chunk
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    # Fixed schema, a chunk where a column is all nulls must not change its type
+    schema = pa.schema([(column, pa.timestamp("us") if column in TIME_COLUMNS else pa.float64()) for column in columns])
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    async for rows in chunks:
+        writer.write_batch(pa.RecordBatch.from_arrays([pa.array(values, type=field.type) for field, values in zip(schema, zip(*rows))], schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+SERIALIZERS = {"ndjson": ndjson, "csv": csv_, "arrow": arrow}
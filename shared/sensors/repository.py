@@ -1,16 +1,27 @@
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from datetime import datetime
+import asyncio
 import json
-
-from shared.mongodb_client import MongoDBClient
-from shared.redis_client import RedisClient
-from shared.cassandra_client import CassandraClient
-from shared.timescale import Timescale
-from shared.elasticsearch_client import ElasticsearchClient
+import os
+
+from asyncpg import Connection
+from shared.mongodb_client import AsyncMongoDBClient
+from shared.redis_client import AsyncRedisClient, RedisClient
+from shared.cassandra_client import AsyncCassandraClient, CassandraClient
+from shared.timescale import AsyncTimescalePool, Timescale, stream_records
+from shared.elasticsearch_client import AsyncElasticsearchClient, ElasticsearchClient
+from shared import codec
+from shared.publisher import INDEX_QUEUE, AsyncPublisher
+from shared.sensor_cache import SensorCache
+from shared.bucket_cache import BUCKETS, AsyncBucketCache, bucket_start, bucket_starts, next_bucket, parse_time
 from shared.sensors import models, schemas
-from shared.timescale import Timescale
+
+# The functions used by the API are coroutines over the asyncio clients, the record_*_batch
+# functions used by the consumers stay synchronous
 
 
 class DataCommand():
@@ -24,40 +35,48 @@ class DataCommand():
         self.bucket = bucket
 
 
-def get_sensor(mongodb: MongoDBClient, sensor_id: int) -> Optional[models.Sensor]:
-    sensor = mongodb.get_sensor({"id": sensor_id})
+async def get_sensor(mongodb: AsyncMongoDBClient, sensor_id: int, cache: SensorCache = None) -> Optional[dict]:
+    if cache is not None:
+        return await cache.get(sensor_id)
+    sensor = await mongodb.get_sensor({"id": sensor_id})
     return sensor
 
-def get_sensor_by_name(db: Session, name: str) -> Optional[models.Sensor]:
-    return db.query(models.Sensor).filter(models.Sensor.name == name).first()
-
-def get_sensors(db: Session, skip: int = 0, limit: int = 100) -> List[models.Sensor]:
-    return db.query(models.Sensor).offset(skip).limit(limit).all()
-
-def add_sensor_to_postgres(db: Session, sensor: schemas.SensorCreate) -> models.Sensor:
-    date = datetime.now()
-
-    db_sensor = models.Sensor(name=sensor.name, joined_at=date)
-    db.add(db_sensor)
-    db.commit()
-    db.refresh(db_sensor)
-
-    return db_sensor
-
-def add_sensor_to_mongodb(mongodb_client: MongoDBClient, db_sensor: schemas.SensorCreate, id):
-    mongo_projection = schemas.SensorMongoProjection(id=id, name=db_sensor.name, location={'type': 'Point',
-                                                                                           'coordinates': [
-                                                                                               db_sensor.longitude,
-                                                                                               db_sensor.latitude]},
-                                                     type=db_sensor.type, mac_address=db_sensor.mac_address,
-                                                     description=db_sensor.description,
-                                                     serie_number=db_sensor.serie_number,
-                                                     firmware_version=db_sensor.firmware_version, model=db_sensor.model,
-                                                     manufacturer=db_sensor.manufacturer)
-    mongodb_client.getDatabase()
-    mongoInsert = mongo_projection.dict()
-    mongodb_client.getCollection().insert_one(mongoInsert)
-    return mongo_projection.dict()
+async def get_sensor_by_name(db: AsyncSession, name: str) -> Optional[models.Sensor]:
+    return (await db.execute(select(models.Sensor).where(models.Sensor.name == name))).scalars().first()
+
+async def get_sensors(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[models.Sensor]:
+    return (await db.execute(select(models.Sensor).offset(skip).limit(limit))).scalars().all()
+
+# Redis GEO set mirroring the sensors' locations, written by create_sensor and delete_sensor
+SENSORS_GEO_KEY = "sensors:geo"
+# Sorted set with the latest battery level of every sensor, maintained by the redis consumer
+SENSORS_BATTERY_KEY = "sensors:battery"
+# Hash with the name of a sensor, written by create_sensor, and its latest reading, written by
+# the redis consumer. Fields are codec.LATEST_FIELDS
+LATEST_KEY = "sensor:{}:latest"
+# Readings per message when a batch is published, the consumers take a list or a single reading
+PUBLISH_BATCH_SIZE = int(os.environ.get("PUBLISH_BATCH_SIZE", 500))
+# Number of sensors of each type, create_sensor increments it and delete_sensor decrements it
+UPDATE_QUANTITY = "UPDATE sensor.quantity_by_type SET quantity = quantity + ? WHERE sensor_type = ?;"
+SELECT_QUANTITY = "SELECT sensor_type, quantity FROM sensor.quantity_by_type;"
+# Serve /sensors/near from the redis mirror instead of mongo's 2dsphere index
+NEAR_REDIS_GEO = os.environ.get("NEAR_REDIS_GEO") == "1"
+
+# Longer ranges skip the bucket cache and are read straight from the view
+MAX_CACHED_BUCKETS = 1000
+
+# Hot timescale statement of the consumer, prepared once per connection
+INSERT_SENSOR_DATA = """INSERT INTO sensor_data (sensor_id, temperature, humidity, velocity, battery_level, last_seen)
+             SELECT * FROM unnest($1, $2, $3, $4, $5, $6)
+             ON CONFLICT (sensor_id, last_seen) DO UPDATE SET temperature = EXCLUDED.temperature, humidity=EXCLUDED.humidity, velocity=EXCLUDED.velocity, battery_level=EXCLUDED.battery_level"""
+INSERT_SENSOR_DATA_TYPES = ("int[]", "float8[]", "float8[]", "float8[]", "float8[]", "timestamp[]")
+
+# Reads one of the continuous aggregates in migrations_ts, starting at the bucket that contains $3.
+# $2 is the bucket width as text ('1 month' has no timedelta equivalent)
+SELECT_VIEW = """SELECT sensor_id, bucket, velocity, temperature, humidity
+            FROM {view}
+            WHERE sensor_id = $1 AND bucket >= time_bucket($2::text::interval, $3::timestamp) AND bucket <= $4
+            ORDER BY bucket"""
 
 def getView(bucket: str) -> str:
     if bucket == 'year':
@@ -73,19 +92,11 @@ def getView(bucket: str) -> str:
     else:
         raise ValueError("Invalid bucket size")
 
-def delete_sensor(db: Session, sensor_id: int):
-    db_sensor = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
-    if db_sensor is None:
-        raise HTTPException(status_code=404, detail="Sensor not found")
-    db.delete(db_sensor)
-    db.commit()
-    return db_sensor
-
-def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBClient, elastic: ElasticsearchClient, cassandra: CassandraClient) -> Optional[models.Sensor]:
+async def create_sensor(db: AsyncSession, sensor: schemas.SensorCreate, mongodb: AsyncMongoDBClient, publisher: AsyncPublisher, cassandra: AsyncCassandraClient, redis: AsyncRedisClient, cache: SensorCache = None) -> dict:
     db_sensor = models.Sensor(name=sensor.name)
     db.add(db_sensor)
-    db.commit()
-    db.refresh(db_sensor)
+    await db.commit()
+    await db.refresh(db_sensor)
     sensor2 = {
         "id": db_sensor.id,
         "name": sensor.name,
@@ -100,184 +111,372 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBCli
         "description":sensor.description
     }
 
-    return_value = mongodb.set_sensor(sensor2)
-
-    document_to_index = {
-         "name": sensor2["name"],
-         "type": sensor2["type"],
-         "description": sensor2["description"]
-     }
-    
-    elastic.index_document(index_name="sensors", document=document_to_index)
-    
-    query = f"INSERT INTO sensor.quantity(sensor_id, sensor_type) VALUES ({db_sensor.id}, '{sensor.type}');"
-    cassandra.execute(query)
-
-    sensor_info = mongodb.get_sensor({"id":db_sensor.id})
-    return sensor_info
-
-def record_data(redis: RedisClient, sensor_id: int, data: schemas.SensorData, ts: Timescale, cassandra: CassandraClient) -> schemas.Sensor:
-    db_sensordata = {
-        "velocity": data.velocity,
-        "temperature": data.temperature,
-        "humidity": data.humidity,
-        "battery_level": data.battery_level,
-        "last_seen": data.last_seen
-    }
-    
-    ts_data = {key: value if value is not None else 'NULL' for key, value in db_sensordata.items()}
-    ts_data['last_seen'] = f"'{ts_data['last_seen']}'"
-
-
-
-    query = f"""INSERT INTO sensor_data (sensor_id, temperature, humidity, velocity, battery_level, last_seen) 
-             VALUES ({sensor_id}, {ts_data['temperature']}, {ts_data['humidity']}, {ts_data['velocity']}, {ts_data['battery_level']}, {ts_data['last_seen']})
-             ON CONFLICT (sensor_id, last_seen) DO UPDATE SET temperature = EXCLUDED.temperature, humidity=EXCLUDED.humidity, velocity=EXCLUDED.velocity, battery_level=EXCLUDED.battery_level;"""
-
-    ts.execute(query)
-    ts.execute("commit")
-
-    if data.temperature is not None:
-        cassandra.execute("INSERT INTO sensor.temp_values (sensor_id, temp) VALUES (" + str(sensor_id) + ", " + str(data.temperature) + ");")
-    
-    cassandra.execute("INSERT INTO sensor.low_bat (sensor_id, battery) VALUES (" + str(sensor_id) + ", " + str(data.battery_level) + ");")
-
-    redis.set(sensor_id, db_sensordata)
-
-
+    # Location and name go to redis in the same round trip
+    pipeline = redis.pipeline()
+    pipeline.geoadd(SENSORS_GEO_KEY, [sensor.longitude, sensor.latitude, db_sensor.id])
+    pipeline.hset(LATEST_KEY.format(db_sensor.id), "name", sensor.name)
+
+    # Once postgres has given the id the other stores are written concurrently
+    await asyncio.gather(
+        mongodb.set_sensor({**sensor2, "location": {"type": "Point", "coordinates": [sensor.longitude, sensor.latitude]}}),
+        pipeline.execute(),
+        cassandra.execute(UPDATE_QUANTITY, (1, sensor.type)),
+        publisher.publish_to_queue(INDEX_QUEUE, {"action": "index", "document": sensor2}),
+        # Forgets a cached "not a sensor" in every API process
+        publisher.publish_event({"action": "create", "id": db_sensor.id}))
+    # This process doesn't wait for its own event, which is late while RabbitMQ is away
+    if cache is not None:
+        cache.invalidate(db_sensor.id)
+
+    # Same fields mongo returns with PROJECTION
+    return sensor2
+
+async def publish_data(publisher: AsyncPublisher, sensor_id: int, data: schemas.SensorData) -> schemas.SensorData:
+    await publisher.publish_readings([(sensor_id, data)])
     return data
 
-def get_data(redis: RedisClient, sensor_id: int,  db: Session, ts: Timescale, from_: str, to: str, bucket: str) -> schemas.Sensor:
+def validate_readings(items: List) -> tuple:
+    # Returns the (sensor_id, SensorData) of the valid items and {index: error} of the others
+    readings, errors = {}, {}
+    for index, item in enumerate(items):
+        if isinstance(item, Exception):
+            errors[index] = f"Invalid JSON: {item}"
+            continue
+        if not isinstance(item, dict) or not isinstance(item.get("sensor_id"), int):
+            errors[index] = "sensor_id must be an integer"
+            continue
+        fields = {key: value for key, value in item.items() if key != "sensor_id"}
+        try:
+            readings[index] = (item["sensor_id"], schemas.SensorData(**fields))
+        except ValidationError as e:
+            errors[index] = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    return readings, errors
+
+async def publish_data_batch(publisher: AsyncPublisher, mongodb: AsyncMongoDBClient, items: List, cache: SensorCache = None) -> dict:
+    # items are the decoded {sensor_id, ...SensorData} entries, or the exception raised decoding them
+    readings, errors = validate_readings(items)
+
+    # One lookup for every sensor id of the batch, none for the ids in the cache
+    sensor_ids = list({sensor_id for sensor_id, _ in readings.values()})
+    if cache is not None:
+        existing = set(await cache.get_many(sensor_ids))
+    else:
+        existing = {sensor["id"] for sensor in await mongodb.get_sensors("id", sensor_ids)}
+    for index, (sensor_id, _) in list(readings.items()):
+        if sensor_id not in existing:
+            errors[index] = "Sensor not found"
+            del readings[index]
+
+    accepted = list(readings.values())
+    # One chunk after the other, concurrent chunks could interleave in a full publisher buffer
+    # and reorder a sensor's readings in its partition queue
+    for start in range(0, len(accepted), PUBLISH_BATCH_SIZE):
+        await publisher.publish_readings(accepted[start:start + PUBLISH_BATCH_SIZE])
+
+    results = []
+    for index in range(len(items)):
+        if index in errors:
+            results.append({"index": index, "status": "rejected", "error": errors[index]})
+        else:
+            results.append({"index": index, "status": "accepted"})
+    return {"accepted": len(readings), "rejected": len(errors), "results": results}
+
+# Each record_*_batch receives a list of (sensor_id, SensorData) in arrival order
+
+def record_timescale_batch(ts: Timescale, readings: List[tuple]):
+    # A multi-row upsert can't touch the same row twice, keep the last reading for each key
+    ts_rows = {}
+    for sensor_id, data in readings:
+        ts_rows[(sensor_id, data.last_seen)] = (sensor_id, data.temperature, data.humidity, data.velocity, data.battery_level, data.last_seen)
+
+    if not ts_rows:
+        return
+    # One array per column, whatever the batch size it is the same prepared statement
+    columns = [list(column) for column in zip(*ts_rows.values())]
+    ts.execute_prepared("insert_sensor_data", INSERT_SENSOR_DATA_TYPES, INSERT_SENSOR_DATA, columns)
+    ts.commit()
+
+def late_bucket_ranges(readings: List[tuple]) -> dict:
+    # {view: (start, end)} covering the already closed buckets the readings fall in. Those may be
+    # below the aggregates' materialization watermark, where real-time aggregation doesn't see them
+    now = datetime.utcnow()
+    ranges = {}
+    for bucket in BUCKETS:
+        starts = [bucket_start(bucket, parse_time(data.last_seen)) for _, data in readings]
+        closed = [start for start in starts if next_bucket(bucket, start) <= now]
+        if closed:
+            ranges[getView(bucket)] = (min(closed), next_bucket(bucket, max(closed)))
+    return ranges
+
+def merge_ranges(ranges: dict, other: dict):
+    for view, (start, end) in other.items():
+        current = ranges.get(view)
+        ranges[view] = (min(current[0], start), max(current[1], end)) if current else (start, end)
+
+def refresh_aggregates(ts: Timescale, ranges: dict):
+    for view, (start, end) in ranges.items():
+        ts.refresh_aggregate(view, start, end)
+
+def merge_stats(stats: dict, key, other: tuple):
+    # Temperature statistics are (min, max, sum, count)
+    current = stats.get(key)
+    if current is None:
+        stats[key] = other
+    else:
+        stats[key] = (min(current[0], other[0]), max(current[1], other[1]), current[2] + other[2], current[3] + other[3])
+
+def temperature_stats(readings: List[tuple]) -> tuple:
+    # Statistics of the batch per sensor and per (sensor, day)
+    totals, daily = {}, {}
+    for sensor_id, data in readings:
+        if data.temperature is None:
+            continue
+        reading = (data.temperature, data.temperature, data.temperature, 1)
+        merge_stats(totals, sensor_id, reading)
+        merge_stats(daily, (sensor_id, parse_time(data.last_seen).date()), reading)
+    return totals, daily
+
+def record_cassandra_batch(cassandra: CassandraClient, readings: List[tuple]):
+    totals, daily = temperature_stats(readings)
+    if not totals:
+        return
+
+    # Read, merge and write back the running statistics. This needs a single writer per
+    # sensor, which the cassandra consumer queue gives us.
+    current_totals = cassandra.execute_async("SELECT sensor_id, min_temp, max_temp, sum_temp, count FROM sensor.temp_stats WHERE sensor_id IN ?;", (list(totals),))
+    current_daily = cassandra.execute_async("SELECT sensor_id, day, min_temp, max_temp, sum_temp, count FROM sensor.temp_stats_daily WHERE sensor_id IN ? AND day IN ?;", (list(totals), list({day for _, day in daily})))
+    for row in current_totals.result():
+        merge_stats(totals, row.sensor_id, (row.min_temp, row.max_temp, row.sum_temp, row.count))
+    for row in current_daily.result():
+        if (row.sensor_id, row.day.date()) in daily:
+            merge_stats(daily, (row.sensor_id, row.day.date()), (row.min_temp, row.max_temp, row.sum_temp, row.count))
+
+    write_temperature_stats(cassandra, totals, daily)
+
+def write_temperature_stats(cassandra: CassandraClient, totals: dict, daily: dict):
+    statements = [("INSERT INTO sensor.temp_stats (sensor_id, min_temp, max_temp, sum_temp, count) VALUES (?, ?, ?, ?, ?);", (sensor_id, *stats)) for sensor_id, stats in totals.items()]
+    statements += [("INSERT INTO sensor.temp_stats_daily (sensor_id, day, min_temp, max_temp, sum_temp, count) VALUES (?, ?, ?, ?, ?, ?);", (sensor_id, day, *stats)) for (sensor_id, day), stats in daily.items()]
+    cassandra.execute_bulk(statements)
+
+def record_redis_batch(redis: RedisClient, readings: List[tuple]):
+    latest = {}
+    for sensor_id, data in readings:
+        latest[sensor_id] = data
+    # Latest values and battery levels go in the same round trip
+    pipeline = redis.pipeline()
+    redis.hset_many({LATEST_KEY.format(sensor_id): codec.encode_latest(data) for sensor_id, data in latest.items()}, pipeline=pipeline)
+    pipeline.zadd(SENSORS_BATTERY_KEY, {sensor_id: data.battery_level for sensor_id, data in latest.items()})
+    pipeline.execute()
+
+async def get_buckets(ts: Connection, view: str, sensor_id: int, bucket: str, from_, to) -> List[list]:
+    rows = await ts.fetch(SELECT_VIEW.format(view=view), sensor_id, "1 " + bucket, from_, to)
+    return [[row[0], row[1].isoformat(), row[2], row[3], row[4]] for row in rows]
+
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 5000))
+EXPORT_RAW_COLUMNS = ("last_seen", "temperature", "humidity", "velocity", "battery_level")
+EXPORT_BUCKET_COLUMNS = ("bucket", "velocity", "temperature", "humidity")
+
+def export_data(ts: Connection, sensor_id: int, from_: str, to: str, bucket: str = None, chunk_size: int = EXPORT_CHUNK_SIZE) -> tuple:
+    # Returns the columns and an async iterator of row chunks read from a server-side cursor,
+    # raw readings or, with bucket, the rows of its continuous aggregate
+    try:
+        from_time, to_time = parse_time(from_), parse_time(to)
+        view = getView(bucket) if bucket is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if view is None:
+        query = """SELECT last_seen, temperature, humidity, velocity, battery_level FROM sensor_data
+                   WHERE sensor_id = $1 AND last_seen >= $2 AND last_seen <= $3 ORDER BY last_seen"""
+        return EXPORT_RAW_COLUMNS, stream_records(ts, query, (sensor_id, from_time, to_time), chunk_size=chunk_size)
+    query = f"""SELECT bucket, velocity, temperature, humidity FROM {view}
+                WHERE sensor_id = $1 AND bucket >= time_bucket($2::text::interval, $3::timestamp) AND bucket <= $4 ORDER BY bucket"""
+    return EXPORT_BUCKET_COLUMNS, stream_records(ts, query, (sensor_id, "1 " + bucket, from_time, to_time), chunk_size=chunk_size)
+
+async def get_latest(redis: AsyncRedisClient, sensor_ids: List[int]) -> List[Optional[dict]]:
+    # Name and latest reading of every sensor in one round trip, None for the ones that don't exist
+    return [codec.decode_latest(values) for values in await redis.hmget_many([LATEST_KEY.format(sensor_id) for sensor_id in sensor_ids], codec.LATEST_FIELDS)]
+
+async def get_data(redis: AsyncRedisClient, sensor_id: int, timescale: AsyncTimescalePool, from_: str, to: str, bucket: str, cache: AsyncBucketCache = None) -> schemas.Sensor:
+    # A timescale connection is only taken for the buckets that have to be queried, the
+    # latest value doesn't need the pool at all
     if from_ is not None and to is not None and bucket is not None:
-        query = f"""
-            SELECT 
-                sensor_id,
-                time_bucket('1 {bucket}', last_seen) AS {bucket},
-                AVG(velocity) AS velocity,
-                AVG(temperature) AS temperature,
-                AVG(humidity) AS humidity
-            FROM sensor_data
-            WHERE sensor_id = {sensor_id} AND last_seen >= '{from_}' AND last_seen <= '{to}'
-            GROUP BY sensor_id, {bucket};
-        """
-        
-        ts.execute(query)
-        result = ts.cursor.fetchall()
-
+        try:
+            view = getView(bucket)
+            from_time, to_time = parse_time(from_), parse_time(to)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        starts = bucket_starts(bucket, from_time, to_time, limit=MAX_CACHED_BUCKETS) if cache is not None else None
+        if starts is None:
+            async with timescale.acquire() as ts:
+                return await get_buckets(ts, view, sensor_id, bucket, from_time, to_time)
+
+        # Closed buckets come from the cache, the open one and any missing ones from timescale
+        now = datetime.utcnow()
+        closed = [start for start in starts if next_bucket(bucket, start) <= now]
+        cached, generation = await cache.get(sensor_id, bucket, closed)
+        missing = [start for start in starts if start not in cached]
+        fetched = {}
+        if missing:
+            async with timescale.acquire() as ts:
+                rows = await get_buckets(ts, view, sensor_id, bucket, missing[0], missing[-1])
+            fetched = {parse_time(row[1]): row for row in rows}
+            await cache.put(sensor_id, bucket, {start: fetched.get(start) for start in missing if next_bucket(bucket, start) <= now}, generation)
+
+        result = []
+        for start in starts:
+            row = cached[start] if start in cached else fetched.get(start)
+            if row is not None:
+                result.append(row)
         return result
 
     else:
-        db_sensordata = redis.get(sensor_id)
-
-        if db_sensordata is None:
+        latest, = await get_latest(redis, [sensor_id])
+        # A sensor without readings has only its name
+        if latest is None or latest["last_seen"] is None:
             raise HTTPException(status_code=404, detail="Sensor not found")
-        
-        db_sensordata["id"] = sensor_id
-        db_sensordata["name"] = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first().name
-    
-        return db_sensordata
+        return {"id": sensor_id, **latest}
 
-def delete_sensor(db: Session, sensor_id: int, mongodb: MongoDBClient, redis: RedisClient, ts: Timescale):
-    db_sensor = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
+async def delete_sensor(db: AsyncSession, sensor: dict, mongodb: AsyncMongoDBClient, redis: AsyncRedisClient, ts: Connection, cassandra: AsyncCassandraClient, publisher: AsyncPublisher, cache: SensorCache = None, bucket_cache: AsyncBucketCache = None):
+    # sensor is the mongo document the caller looked up to check that it exists
+    sensor_id = sensor["id"]
+    db_sensor = await db.get(models.Sensor, sensor_id)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    db.delete(db_sensor)
-    db.commit()
+    await db.delete(db_sensor)
+    await db.commit()
 
     query_delete = {"id": sensor_id}
-    mongodb.delete(query_delete)
 
-    redis.delete(sensor_id)
-
-    query = "DELETE FROM sensor_data WHERE sensor_id = " + str(sensor_id)
-    ts.execute(query)
+    pipeline = redis.pipeline()
+    pipeline.unlink(LATEST_KEY.format(sensor_id))
+    pipeline.zrem(SENSORS_GEO_KEY, sensor_id)
+    pipeline.zrem(SENSORS_BATTERY_KEY, sensor_id)
+
+    # The rest of the stores are independent of each other
+    writes = [
+        mongodb.delete(query_delete),
+        publisher.publish_to_queue(INDEX_QUEUE, {"action": "delete", "id": sensor_id}),
+        publisher.publish_event({"action": "delete", "id": sensor_id}),
+        pipeline.execute(),
+        ts.execute("DELETE FROM sensor_data WHERE sensor_id = $1", sensor_id),
+        cassandra.execute(UPDATE_QUANTITY, (-1, sensor["type"])),
+    ]
+    if bucket_cache is not None:
+        writes.append(bucket_cache.delete(sensor_id))
+    await asyncio.gather(*writes)
+    if cache is not None:
+        cache.invalidate(sensor_id)
     return db_sensor
 
-def get_temperature_values(mongodb: MongoDBClient, cassandra: CassandraClient):
-    db_sensor = cassandra.execute("SELECT sensor_id, MAX(temp) as max_temp, MIN(temp) as min_temp, AVG(temp) as avg_temp FROM sensor.temp_values GROUP BY sensor_id;")
-    
+async def get_sensors_by_id(mongodb: AsyncMongoDBClient, sensor_ids: List[int]) -> dict:
+    # One $in query for all the ids, returns {id: sensor}
+    return {sensor["id"]: sensor for sensor in await mongodb.get_sensors("id", sensor_ids)}
+
+async def get_temperature_values(mongodb: AsyncMongoDBClient, cassandra: AsyncCassandraClient):
+    # One precomputed row per sensor, maintained by the cassandra consumer
+    rows = sorted(await cassandra.execute("SELECT sensor_id, min_temp, max_temp, sum_temp, count FROM sensor.temp_stats;"), key=lambda row: row.sensor_id)
+    sensors_by_id = await get_sensors_by_id(mongodb, [row.sensor_id for row in rows])
+
     sensors = []
-    for row in db_sensor:
-        sensor_id = row.sensor_id
-        data_sensor = get_sensor(mongodb, sensor_id)
-        data_sensor["values"] = {"max_temperature": row.max_temp, "min_temperature": row.min_temp, "average_temperature": row.avg_temp}
+    for row in rows:
+        data_sensor = sensors_by_id.get(row.sensor_id)
+        if data_sensor is None:
+            continue
+        data_sensor["values"] = {"max_temperature": row.max_temp, "min_temperature": row.min_temp, "average_temperature": row.sum_temp / row.count}
         sensors.append(data_sensor)
     
     return {"sensors": sensors}
 
-def get_sensors_quantity(db: Session, cassandra_client: CassandraClient):
-    db_sensor = cassandra_client.execute("SELECT sensor_type, COUNT(*) FROM sensor.quantity GROUP BY sensor_type;")
-    
+def quantity_counters(rows) -> dict:
+    # One counter row per type, returns {type: quantity}
+    return {row.sensor_type: row.quantity for row in rows}
+
+async def get_sensors_quantity(db: AsyncSession, cassandra_client: AsyncCassandraClient):
+    counters = quantity_counters(await cassandra_client.execute(SELECT_QUANTITY))
+
     sensors = list()
-    for row in db_sensor:
-        type_dict = {"type":row.sensor_type, "quantity": row.count}
-        sensors.append(type_dict)
-    
+    for sensor_type in sorted(counters):
+        if counters[sensor_type] > 0:
+            sensors.append({"type": sensor_type, "quantity": counters[sensor_type]})
+
     return {"sensors": sensors}
 
-def get_low_battery_sensors(mongodb: MongoDBClient, cassandra: CassandraClient):
-    db_sensor = cassandra.execute("SELECT * FROM sensor.low_bat WHERE battery <= 0.2 ALLOW FILTERING;")
+async def get_low_battery_sensors(mongodb: AsyncMongoDBClient, redis: AsyncRedisClient, threshold: float = 0.2, skip: int = 0, limit: int = 100):
+    # Range read over the latest battery level of each sensor, lowest first
+    levels = await redis.range_by_score(SENSORS_BATTERY_KEY, threshold, skip, limit)
+    sensors_by_id = await get_sensors_by_id(mongodb, [int(member) for member, _ in levels])
 
     sensors = list()
-    for row in db_sensor:
-        sensor_id = row.sensor_id
-        data_sensor = get_sensor(mongodb, sensor_id)
-        data_sensor.update({"battery_level": round(row.battery, 2)})
-        sensors.append(data_sensor)
+    for member, battery in levels:
+        data_sensor = sensors_by_id.get(int(member))
+        if data_sensor is None:
+            continue
+        sensors.append({**data_sensor, "battery_level": round(battery, 2)})
 
     return {"sensors": sensors}
 
-def search_sensors(db: Session,mongodb: MongoDBClient, elastic: ElasticsearchClient, query: str, size: int, search_type: str):
-    search = list()
+async def search_sensors(elastic: AsyncElasticsearchClient, query: str, size: int, search_type: str, skip: int = 0):
     query2 = json.loads(query)
 
     if search_type == "similar":
         search_type = "fuzzy"
 
+    # The documents hold the whole sensor, the hits are the response
     query_search = {
         "query":{
             search_type: query2
-        }
+        },
+        "size": size,
+        "from": skip,
+        "sort": ["_score", {"id": "asc"}]
     }
 
-    results = elastic.search(index_name="sensors", query=query_search)
-
-    for hit in results['hits']['hits']:
-        name = hit["_source"]["name"]
-        sensor = mongodb.get_sensor({"name": name})
-
-        search.append(sensor)
-
-        if len(search) == size:
-            break
-    return search
-
-def get_sensor_documentals(db: Session, sensor_id: int) -> Optional[models.Sensor]:
-    return db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
-
-def get_data_documentals(redis: RedisClient, sensor_id: int, db: Session) -> dict:
-    db_sensor = redis.get(sensor_id)
-
-    if db_sensor:
-        sensor_data = db_sensor
-        sensor_data["id"] = sensor_id
-        sensor_data["name"] = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first().name
-
-        return sensor_data
-
-def get_sensor_near(mongodb: MongoDBClient, redis: RedisClient, latitude: float, longitude: float, radius: float, db:Session)->List:
-    query = {"latitude":{"$gte":latitude - radius,"$lte":latitude + radius}, "longitude":{"$gte": longitude-radius, "$lte":longitude+radius}}
-    documents = list(mongodb.getDocuments(query))
-
-    for i in documents:
-        db_sensor = get_sensor_documentals(db=db, sensor_id=i['id'])
-
-        db_sensor=get_data_documentals(redis=redis,sensor_id=db_sensor.id,db=db)
-
-        i['velocity']=db_sensor['velocity']
-        i['temperature']=db_sensor['temperature']
-        i['humidity']=db_sensor['humidity']
-        i['battery_level']=db_sensor['battery_level']
-        i['last_seen']=db_sensor['last_seen']
-    
-    return documents
\ No newline at end of file
+    results = await elastic.search(index_name="sensors", query=query_search)
+    return [hit["_source"] for hit in results['hits']['hits']]
+
+def elasticsearch_actions(messages: List[dict]) -> List[dict]:
+    # Messages of the index queue to bulk API actions, the sensor id is the document id
+    actions = []
+    for message in messages:
+        if message["action"] == "index":
+            actions.append({"_op_type": "index", "_index": "sensors", "_id": message["document"]["id"], "_source": message["document"]})
+        elif message["action"] == "delete":
+            actions.append({"_op_type": "delete", "_index": "sensors", "_id": message["id"]})
+        else:
+            raise ValueError(f"Unknown action {message['action']}")
+    return actions
+
+def record_elasticsearch_batch(elastic: ElasticsearchClient, messages: List[dict]):
+    # Documents become searchable on the next index refresh (every second by default)
+    if messages:
+        elastic.bulk(elasticsearch_actions(messages))
+
+async def get_sensor_near(mongodb: AsyncMongoDBClient, redis: AsyncRedisClient, latitude: float, longitude: float, radius: float, limit: int = 100)->List:
+    # radius is in metres, results are sorted by distance
+    if NEAR_REDIS_GEO:
+        hits = await redis.geosearch(SENSORS_GEO_KEY, longitude, latitude, radius, limit)
+        sensors_by_id = await get_sensors_by_id(mongodb, [int(member) for member, _ in hits])
+        documents = []
+        for member, distance in hits:
+            document = sensors_by_id.get(int(member))
+            if document is not None:
+                documents.append({**document, "distance": distance})
+    else:
+        documents = await mongodb.near(longitude, latitude, radius, limit)
+
+    # Only registered sensors have a name in their latest-value hash
+    latest = await get_latest(redis, [i['id'] for i in documents])
+    result = []
+    for i, db_sensor in zip(documents, latest):
+        if db_sensor is None:
+            continue
+        if db_sensor['last_seen'] is not None:
+            i['velocity']=db_sensor['velocity']
+            i['temperature']=db_sensor['temperature']
+            i['humidity']=db_sensor['humidity']
+            i['battery_level']=db_sensor['battery_level']
+            i['last_seen']=db_sensor['last_seen']
+        result.append(i)
+
+    return result
@@ -0,0 +1,76 @@
+import asyncio
+import contextlib
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from shared.sensors import export, repository
+
+COLUMNS = ("last_seen", "temperature")
+CHUNKS = [[(datetime(2020, 1, 1), 1.0), (datetime(2020, 1, 2), None)], [(datetime(2020, 1, 3), 3.0)]]
+
+
+async def chunks(items=CHUNKS):
+    for rows in items:
+        yield rows
+
+
+def collect(pieces):
+    async def run():
+        return [piece async for piece in pieces]
+    return asyncio.run(run())
+
+
+def test_ndjson_yields_one_piece_per_chunk():
+    pieces = collect(export.ndjson(COLUMNS, chunks()))
+    assert pieces == [
+        b'{"last_seen":"2020-01-01T00:00:00","temperature":1.0}\n{"last_seen":"2020-01-02T00:00:00","temperature":null}\n',
+        b'{"last_seen":"2020-01-03T00:00:00","temperature":3.0}\n',
+    ]
+
+
+def test_csv_starts_with_the_header():
+    body = b"".join(collect(export.csv_(COLUMNS, chunks()))).decode()
+    assert body.splitlines() == ["last_seen,temperature", "2020-01-01T00:00:00,1.0", "2020-01-02T00:00:00,", "2020-01-03T00:00:00,3.0"]
+    assert b"".join(collect(export.csv_(COLUMNS, chunks([])))) == b"last_seen,temperature\r\n"
+
+
+def test_arrow_round_trip():
+    pa = pytest.importorskip("pyarrow")
+    body = b"".join(collect(export.arrow(COLUMNS, chunks())))
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.column("temperature").to_pylist() == [1.0, None, 3.0]
+
+
+class FakeConnection:
+    # The parts of an asyncpg connection a server-side cursor uses
+    def __init__(self):
+        self.queries = []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def cursor(self, query, *params, prefetch):
+        self.queries.append((query, params, prefetch))
+        for rows in CHUNKS:
+            for row in rows:
+                yield row
+
+
+def test_export_data_streams_the_view_of_the_bucket():
+    ts = FakeConnection()
+    columns, rows = repository.export_data(ts=ts, sensor_id=1, from_="2020-01-01T00:00:00.000Z", to="2020-01-04T00:00:00.000Z", bucket="day", chunk_size=2)
+    assert columns == repository.EXPORT_BUCKET_COLUMNS
+    assert collect(rows) == [CHUNKS[0], CHUNKS[1]]
+    query, params, prefetch = ts.queries[0]
+    assert "FROM sensor_data_daily" in query
+    assert params == (1, "1 day", datetime(2020, 1, 1), datetime(2020, 1, 4))
+    assert prefetch == 2
+
+
+def test_export_data_rejects_an_invalid_bucket():
+    with pytest.raises(HTTPException) as e:
+        repository.export_data(ts=FakeConnection(), sensor_id=1, from_="2020-01-01", to="2020-01-02", bucket="minute")
+    assert e.value.status_code == 400
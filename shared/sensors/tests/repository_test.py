@@ -0,0 +1,192 @@
+from collections import namedtuple
+from datetime import date, datetime
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from shared.sensors import repository, schemas
+
+# Fake asyncio clients that count round trips, these tests don't need the docker stores
+
+Row = namedtuple("Row", ["sensor_id", "min_temp", "max_temp", "sum_temp", "count"])
+
+
+def sensor(sensor_id):
+    return {"id": sensor_id, "name": f"Sensor {sensor_id}", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura"}
+
+
+class FakeMongo:
+    def __init__(self, n):
+        self.sensors = [sensor(i) for i in range(1, n + 1)]
+        self.calls = 0
+
+    async def get_sensors(self, field, values):
+        self.calls += 1
+        return [dict(s) for s in self.sensors if s[field] in values]
+
+    async def near(self, longitude, latitude, radius, limit):
+        self.calls += 1
+        return [dict(s) for s in self.sensors][:limit]
+
+
+class FakeCassandra:
+    def __init__(self, n):
+        self.rows = [Row(i, 1.0, 2.0, 3.0, 2) for i in range(1, n + 1)]
+        self.calls = 0
+
+    async def execute(self, query, params=()):
+        self.calls += 1
+        return list(self.rows)
+
+
+class FakeElastic:
+    def __init__(self, n):
+        self.hits = [{"_source": sensor(i)} for i in range(1, n + 1)]
+        self.calls = 0
+        self.queries = []
+
+    async def search(self, index_name, query):
+        self.calls += 1
+        self.queries.append(query)
+        return {"hits": {"hits": self.hits[query["from"]:query["from"] + query["size"]]}}
+
+
+class FakeRedis:
+    def __init__(self, n=0):
+        self.n = n
+        self.calls = 0
+
+    async def range_by_score(self, key, max_score, offset, count):
+        self.calls += 1
+        return [(str(i).encode(), 0.1) for i in range(1, self.n + 1)][offset:offset + count]
+
+    async def hmget_many(self, keys, fields):
+        self.calls += 1
+        self.keys = keys
+        return [[b"sensor", b"", b"1.0", b"1.0", b"1.0", b"2020-01-01T00:00:00"] if key != "sensor:404:latest" else [None] * len(fields) for key in keys]
+
+
+SIZES = [1, 10, 100]
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_temperature_values_round_trips(n):
+    mongodb, cassandra = FakeMongo(n), FakeCassandra(n)
+    result = asyncio.run(repository.get_temperature_values(mongodb=mongodb, cassandra=cassandra))
+    assert len(result["sensors"]) == n
+    assert result["sensors"][0]["values"]["average_temperature"] == 1.5
+    assert (mongodb.calls, cassandra.calls) == (1, 1)
+
+
+def test_late_bucket_ranges_are_merged_per_view():
+    ranges = repository.late_bucket_ranges([(1, schemas.SensorData(temperature=1.0, battery_level=1.0, last_seen="2020-01-01T10:30:00"))])
+    assert ranges["sensor_data_hourly"] == (datetime(2020, 1, 1, 10), datetime(2020, 1, 1, 11))
+    repository.merge_ranges(ranges, {"sensor_data_hourly": (datetime(2020, 1, 3), datetime(2020, 1, 3, 1))})
+    assert ranges["sensor_data_hourly"] == (datetime(2020, 1, 1, 10), datetime(2020, 1, 3, 1))
+    assert set(ranges) == {repository.getView(bucket) for bucket in ("hour", "day", "week", "month", "year")}
+
+
+def test_temperature_stats_per_sensor_and_day():
+    readings = [
+        (1, schemas.SensorData(temperature=1.0, battery_level=1.0, last_seen="2020-01-01T10:00:00")),
+        (1, schemas.SensorData(temperature=3.0, battery_level=1.0, last_seen="2020-01-02T10:00:00")),
+        (1, schemas.SensorData(battery_level=1.0, last_seen="2020-01-02T11:00:00")),
+        (2, schemas.SensorData(temperature=5.0, battery_level=1.0, last_seen="2020-01-01T10:00:00")),
+    ]
+    totals, daily = repository.temperature_stats(readings)
+    assert totals == {1: (1.0, 3.0, 4.0, 2), 2: (5.0, 5.0, 5.0, 1)}
+    assert daily == {
+        (1, date(2020, 1, 1)): (1.0, 1.0, 1.0, 1),
+        (1, date(2020, 1, 2)): (3.0, 3.0, 3.0, 1),
+        (2, date(2020, 1, 1)): (5.0, 5.0, 5.0, 1),
+    }
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_low_battery_round_trips(n):
+    mongodb, redis = FakeMongo(n), FakeRedis(n)
+    result = asyncio.run(repository.get_low_battery_sensors(mongodb=mongodb, redis=redis, limit=n))
+    assert len(result["sensors"]) == n
+    assert (mongodb.calls, redis.calls) == (1, 1)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_search_round_trips(n):
+    elastic = FakeElastic(n)
+    result = asyncio.run(repository.search_sensors(elastic=elastic, query=json.dumps({"type": "Temperatura"}), size=n, search_type="match"))
+    assert result == [sensor(i) for i in range(1, n + 1)]
+    assert elastic.calls == 1
+
+
+def test_search_pushes_size_and_skip_down():
+    elastic = FakeElastic(10)
+    result = asyncio.run(repository.search_sensors(elastic=elastic, query=json.dumps({"type": "Temperatura"}), size=3, search_type="similar", skip=2))
+    assert [s["id"] for s in result] == [3, 4, 5]
+    assert elastic.queries == [{"query": {"fuzzy": {"type": "Temperatura"}}, "size": 3, "from": 2, "sort": ["_score", {"id": "asc"}]}]
+
+
+def test_elasticsearch_actions_use_the_sensor_id():
+    actions = repository.elasticsearch_actions([{"action": "index", "document": sensor(1)}, {"action": "delete", "id": 2}])
+    assert actions == [
+        {"_op_type": "index", "_index": "sensors", "_id": 1, "_source": sensor(1)},
+        {"_op_type": "delete", "_index": "sensors", "_id": 2},
+    ]
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_near_round_trips(n):
+    mongodb, redis = FakeMongo(n), FakeRedis()
+    result = asyncio.run(repository.get_sensor_near(mongodb=mongodb, redis=redis, latitude=1.0, longitude=1.0, radius=1.0))
+    assert len(result) == n
+    assert all(s["temperature"] == 1.0 and s["velocity"] is None for s in result)
+    assert (mongodb.calls, redis.calls) == (1, 1)
+
+
+def test_latest_value_is_one_redis_round_trip():
+    redis = FakeRedis()
+    result = asyncio.run(repository.get_data(redis=redis, sensor_id=1, timescale=None, from_=None, to=None, bucket=None))
+    assert result == {"id": 1, "name": "sensor", "velocity": None, "temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00"}
+    assert (redis.calls, redis.keys) == (1, ["sensor:1:latest"])
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(repository.get_data(redis=redis, sensor_id=404, timescale=None, from_=None, to=None, bucket=None))
+    assert e.value.status_code == 404
+
+
+def test_sensors_quantity_reads_counters_sorted_by_type():
+    cassandra = FakeCassandra(0)
+    Counter = namedtuple("Counter", ["sensor_type", "quantity"])
+    cassandra.rows = [Counter("Velocitat", 2), Counter("Humitat", 0), Counter("Temperatura", 3)]
+    result = asyncio.run(repository.get_sensors_quantity(db=None, cassandra_client=cassandra))
+    assert result == {"sensors": [{"type": "Temperatura", "quantity": 3}, {"type": "Velocitat", "quantity": 2}]}
+    assert cassandra.calls == 1
+
+
+class FakePublisher:
+    def __init__(self):
+        self.messages = []
+
+    async def publish_readings(self, readings):
+        self.messages.append(readings)
+
+
+def test_publish_data_batch_checks_every_sensor_with_one_lookup(monkeypatch):
+    monkeypatch.setattr(repository, "PUBLISH_BATCH_SIZE", 2)
+    mongodb, publisher = FakeMongo(3), FakePublisher()
+    reading = {"temperature": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00"}
+    items = [
+        {"sensor_id": 1, **reading},
+        {"sensor_id": 2, **reading},
+        {"sensor_id": 9, **reading},
+        {"sensor_id": 3, "temperature": 1.0},
+        ["not", "an", "object"],
+        ValueError("Expecting value"),
+        {"sensor_id": 3, **reading},
+    ]
+    result = asyncio.run(repository.publish_data_batch(publisher=publisher, mongodb=mongodb, items=items))
+    assert (result["accepted"], result["rejected"]) == (3, 4)
+    assert [r["status"] for r in result["results"]] == ["accepted", "accepted", "rejected", "rejected", "rejected", "rejected", "accepted"]
+    assert result["results"][2]["error"] == "Sensor not found"
+    assert mongodb.calls == 1
+    assert [[sensor_id for sensor_id, _ in message] for message in publisher.messages] == [[1, 2], [3]]
@@ -0,0 +1,100 @@
+import os
+import struct
+import threading
+
+# One frame per message: exchange name, routing key, message id and body lengths, then the four
+_HEADER = struct.Struct(">HHHI")
+
+
+class SpillFull(Exception):
+    pass
+
+
+class SpillFile:
+    # Append-only files on local disk with the messages the broker could not take, in order.
+    # append() writes to <path>.log. Draining renames it to <path>.drain first, so appends go on
+    # to a fresh log while the old one is read back, and deletes it once every frame is confirmed.
+    # The publisher calls it from worker threads so the disk never blocks its event loop, a lock
+    # keeps appends, reads and commits one at a time.
+    def __init__(self, path, max_bytes):
+        self.log_path = path + ".log"
+        self.drain_path = path + ".drain"
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Left over by a previous run, drained again from the start (delivery is at least once)
+        self.bytes = sum(os.path.getsize(p) for p in (self.log_path, self.drain_path) if os.path.exists(p))
+        self._offset = 0
+        self._next = 0
+        self._eof = False
+        self._lock = threading.Lock()
+
+    def pending(self):
+        return self.bytes > 0
+
+    def append(self, records):
+        with self._lock:
+            self._append(records)
+
+    def _append(self, records):
+        # records are (exchange, routing_key, message_id, body) tuples, all of them are written or none
+        data = b"".join(_HEADER.pack(len(exchange), len(routing_key), len(message_id), len(body)) + exchange + routing_key + message_id + body
+                        for exchange, routing_key, message_id, body in ((e.encode(), k.encode(), i.encode(), b) for e, k, i, b in records))
+        if self.bytes + len(data) > self.max_bytes:
+            raise SpillFull(f"spill file over {self.max_bytes} bytes")
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.bytes += len(data)
+
+    def read(self, count):
+        with self._lock:
+            return self._read(count)
+
+    def _read(self, count):
+        # Up to count records after the last commit(), rotating the log when there is nothing to drain
+        if not os.path.exists(self.drain_path):
+            if not os.path.exists(self.log_path):
+                # Removed behind our back
+                self.bytes = 0
+                self._eof = False
+                return []
+            os.rename(self.log_path, self.drain_path)
+            self._offset = 0
+        records = []
+        with open(self.drain_path, "rb") as f:
+            f.seek(self._offset)
+            offset = self._offset
+            while len(records) < count:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                lengths = _HEADER.unpack(header)
+                frame = f.read(sum(lengths))
+                if len(frame) < sum(lengths):
+                    # Torn write of a crash, the rest of the file is unusable
+                    break
+                fields, start = [], 0
+                for length in lengths:
+                    fields.append(frame[start:start + length])
+                    start += length
+                exchange, routing_key, message_id, body = fields
+                records.append((exchange.decode(), routing_key.decode(), message_id.decode(), body))
+                offset = f.tell()
+            self._next = offset
+            self._eof = len(records) < count
+        return records
+
+    def commit(self):
+        # The records of the last read() are confirmed by the broker
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        self._offset = self._next
+        if self._eof:
+            self.bytes -= os.path.getsize(self.drain_path)
+            os.remove(self.drain_path)
+            self._offset = self._next = 0
@@ -1,13 +1,13 @@
 import pika
 import time
 
-from shared.publisher import QUEUE_NAME
+from shared.publisher import declare_topology
 
 class Subscriber:
-    def __init__(self):
+    def __init__(self, queue):
+        self.queue = queue
         credentials = pika.PlainCredentials('guest', 'guest')
-        # Change the host to rabbitmq
-        parameters = pika.ConnectionParameters('localhost',
+        parameters = pika.ConnectionParameters('rabbitmq',
                                        5672,
                                        '/',
                                        credentials)
@@ -17,14 +17,46 @@ class Subscriber:
             time.sleep(10)
             self.conn = pika.BlockingConnection(parameters)
         self.channel = self.conn.channel()
+        declare_topology(self.channel)
 
 
     def subscribe(self, callback):
-        result = self.channel.queue_declare(queue=QUEUE_NAME)
-        self.channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+        self.channel.basic_consume(queue=self.queue, on_message_callback=callback, auto_ack=True)
         self.channel.start_consuming()
 
+    def subscribe_batch(self, flush, batch_size=100, batch_window_ms=500, prefetch_count=None):
+        # Collects up to batch_size messages or waits batch_window_ms since the first one,
+        # then calls flush(messages) with the (message_id, body) of each, message_id is None for
+        # messages published without one. Messages are only acked once flush returns.
+        # prefetch_count lower than batch_size means batches only close on the window.
+        self.channel.basic_qos(prefetch_count=prefetch_count or batch_size)
+
+        window = batch_window_ms / 1000
+        tick = min(window, 0.1)
+        batch = []
+        deadline = None
+        for method, properties, body in self.channel.consume(self.queue, inactivity_timeout=tick):
+            if method is not None:
+                if not batch:
+                    deadline = time.monotonic() + window
+                batch.append((method.delivery_tag, properties.message_id, body))
+            if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+                self._flush(batch, flush)
+                batch = []
+
+    def _flush(self, batch, flush):
+        last_tag = batch[-1][0]
+        try:
+            flush([(message_id, body) for _, message_id, body in batch])
+        except Exception as e:
+            print("Error flushing batch, requeuing", len(batch), "messages:", e)
+            # Don't spin on a backend that is down
+            time.sleep(1)
+            self.channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            return
+        self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+
     def close(self):
         self.conn.close()
 
-    
\ No newline at end of file
+
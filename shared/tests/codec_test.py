@@ -0,0 +1,50 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from shared import codec
+from shared.sensors import schemas
+
+READINGS = [
+    (1, schemas.SensorData(temperature=21.5, humidity=40.0, battery_level=0.9, last_seen="2020-01-01T00:00:00.000Z")),
+    (2, schemas.SensorData(velocity=3.25, battery_level=0.1, last_seen="2020-01-01T00:00:01.000Z")),
+]
+
+
+def test_readings_round_trip():
+    assert codec.decode_readings(codec.encode_readings(READINGS)) == READINGS
+
+
+def test_readings_are_smaller_than_json():
+    body = json.dumps([{"sensor_id": sensor_id, **data.dict()} for sensor_id, data in READINGS]).encode()
+    assert len(codec.encode_readings(READINGS)) < len(body) / 2
+
+
+def test_json_messages_are_still_decoded():
+    # Queued before the binary format
+    assert codec.decode_readings(json.dumps({"sensor_id": 1, **READINGS[0][1].dict()}).encode()) == READINGS[:1]
+    assert codec.loads(b'{"action": "delete", "id": 1}') == {"action": "delete", "id": 1}
+
+
+@pytest.mark.parametrize("body", [b"", b"\x09\x90", codec.dumps({"sensor_id": 1}), codec.dumps([[1, 2.0]])])
+def test_malformed_readings_are_rejected(body):
+    with pytest.raises(ValueError):
+        codec.decode_readings(body)
+
+
+def test_values_round_trip():
+    value = {"velocity": None, "temperature": 1.5, "last_seen": "2020-01-01T00:00:00"}
+    assert codec.loads(codec.dumps(value)) == value
+
+
+def test_json_response_encodes_datetimes_and_int_keys():
+    body = codec.ORJSONResponse({1: datetime(2020, 1, 1)}).body
+    assert body == b'{"1":"2020-01-01T00:00:00"}'
+
+
+def test_latest_hash_fields_round_trip():
+    fields = codec.encode_latest(READINGS[1][1])
+    values = [b"sensor"] + [fields[field].encode() for field in codec.LATEST_FIELDS[1:]]
+    assert codec.decode_latest(values) == {"name": "sensor", **READINGS[1][1].dict()}
+    assert codec.decode_latest([None] * len(codec.LATEST_FIELDS)) is None
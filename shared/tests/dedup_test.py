@@ -0,0 +1,90 @@
+from shared.dedup import DEDUP_HITS_KEY, DedupCache
+
+
+def message(message_id, body=b"reading"):
+    return message_id, body
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+            return self
+        return command
+
+    def execute(self):
+        results = []
+        for name, args in self.commands:
+            if name == "smismember":
+                results.append([member in self.redis.sets.get(args[0], set()) for member in args[1]])
+            elif name == "sadd":
+                self.redis.sets.setdefault(args[0], set()).update(args[1:])
+            elif name == "hincrby":
+                self.redis.hashes[(args[0], args[1])] = self.redis.hashes.get((args[0], args[1]), 0) + args[2]
+        return results
+
+
+class FakeRedis:
+    def __init__(self):
+        self.sets = {}
+        self.hashes = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+def test_written_messages_are_skipped():
+    dedup = DedupCache("redis:0")
+    messages = [message("a"), message("b"), message("a")]
+    fresh, ids = dedup.filter(messages)
+    assert fresh == messages[:2]
+    dedup.add(ids)
+    fresh, ids = dedup.filter([message("a"), message("c")])
+    assert fresh == [message("c")]
+    assert dedup.hits == 2
+
+
+def test_the_same_reading_published_again_is_not_skipped():
+    # A resend is a new message with its own id, whatever its content
+    dedup = DedupCache("redis:0")
+    dedup.add(dedup.filter([message("a", b"A"), message("b", b"B")])[1])
+    assert dedup.filter([message("c", b"A")])[0] == [message("c", b"A")]
+
+
+def test_messages_without_an_id_are_never_skipped():
+    dedup = DedupCache("redis:0")
+    dedup.add(dedup.filter([message(None)])[1])
+    assert dedup.filter([message(None), message(None)])[0] == [message(None), message(None)]
+
+
+def test_messages_not_added_are_not_skipped():
+    # A failed write is requeued and must be written when it comes back
+    dedup = DedupCache("redis:0")
+    dedup.filter([message("a")])
+    assert dedup.filter([message("a")])[0] == [message("a")]
+
+
+def test_oldest_ids_are_evicted():
+    dedup = DedupCache("redis:0", max_size=2)
+    dedup.add(["a", "b", "c"])
+    fresh, _ = dedup.filter([message("a"), message("b"), message("c")])
+    assert fresh == [message("a")]
+
+
+def test_expired_ids_are_forgotten():
+    dedup = DedupCache("redis:0", ttl=0)
+    dedup.add(["a"])
+    assert dedup.filter([message("a")])[0] == [message("a")]
+
+
+def test_ids_in_redis_survive_a_restart():
+    redis = FakeRedis()
+    first = DedupCache("cassandra:1", redis=redis, persist=True)
+    first.add(first.filter([message("a")])[1])
+    restarted = DedupCache("cassandra:1", redis=redis, persist=True)
+    assert restarted.filter([message("a"), message("b")])[0] == [message("b")]
+    assert redis.hashes == {(DEDUP_HITS_KEY, "cassandra:1"): 1}
@@ -0,0 +1,103 @@
+import asyncio
+
+import aio_pika
+
+from shared import codec
+from shared.publisher import AsyncPublisher, jump_hash, partition
+from shared.sensors import schemas
+
+# The publisher's background tasks against a fake exchange, no broker needed
+
+
+class FakeExchange:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.published = []
+        self.message_ids = []
+
+    async def publish(self, message, routing_key):
+        if self.failures:
+            self.failures -= 1
+            raise aio_pika.exceptions.AMQPConnectionError("broker down")
+        assert message.delivery_mode == aio_pika.DeliveryMode.PERSISTENT
+        self.message_ids.append(message.message_id)
+        self.published.extend((routing_key, sensor_id) for sensor_id, _ in codec.decode_readings(message.body))
+
+
+READING = schemas.SensorData(temperature=1.0, battery_level=1.0, last_seen="2020-01-01T00:00:00")
+
+
+def run(exchange, sensor_ids, spill_path, flush_size=10):
+    async def main():
+        publisher = AsyncPublisher(flush_size=flush_size, spill_path=str(spill_path), drain_interval=0.01)
+        publisher.exchange = exchange
+        publisher._tasks = [asyncio.create_task(publisher._run()), asyncio.create_task(publisher._drain())]
+        for sensor_id in sensor_ids:
+            await publisher.publish_readings([(sensor_id, READING)])
+        await publisher._buffer.join()
+        while publisher.spill.pending():
+            await asyncio.sleep(0.01)
+        await publisher.close()
+        return publisher
+    return asyncio.run(main())
+
+
+def test_messages_are_flushed_in_order_in_batches(tmp_path):
+    exchange = FakeExchange()
+    publisher = run(exchange, range(25), tmp_path / "spill")
+    assert exchange.published == [(str(partition(i)), i) for i in range(25)]
+    metrics = publisher.metrics()
+    assert (metrics["queued"], metrics["published"], metrics["buffered"], metrics["spilled"]) == (25, 25, 0, 0)
+
+
+def test_a_failed_flush_is_spilled_and_drained_in_order(tmp_path):
+    exchange = FakeExchange(failures=2)
+    # One message per flush, so a failure is never half sent
+    publisher = run(exchange, range(25), tmp_path / "spill", flush_size=1)
+    assert exchange.published == [(str(partition(i)), i) for i in range(25)]
+    metrics = publisher.metrics()
+    assert metrics["spilled"] == metrics["drained"] == 25
+    assert (metrics["failed_flushes"], metrics["spill_bytes"]) == (2, 0)
+    # Every message keeps its own id through the spill file
+    assert len(set(exchange.message_ids)) == 25 and None not in exchange.message_ids
+    assert not list(tmp_path.iterdir())
+
+
+def test_messages_are_spilled_until_the_broker_is_up(tmp_path):
+    async def main():
+        publisher = AsyncPublisher(spill_path=str(tmp_path / "spill"), drain_interval=0.01)
+        publisher._tasks = [asyncio.create_task(publisher._run()), asyncio.create_task(publisher._drain())]
+        await publisher.publish_readings([(1, READING)])
+        await publisher._buffer.join()
+        assert publisher.spill.pending()
+        publisher.exchange = exchange = FakeExchange()
+        while publisher.spill.pending():
+            await asyncio.sleep(0.01)
+        await publisher.close()
+        return exchange
+    assert asyncio.run(main()).published == [(str(partition(1)), 1)]
+
+
+def test_a_batch_is_split_by_partition_in_order(tmp_path):
+    exchange = FakeExchange()
+
+    async def main():
+        publisher = AsyncPublisher(spill_path=str(tmp_path / "spill"), partitions=4)
+        publisher.exchange = exchange
+        publisher._tasks = [asyncio.create_task(publisher._run())]
+        await publisher.publish_readings([(i % 10, READING) for i in range(40)])
+        await publisher.close()
+        return publisher
+    publisher = asyncio.run(main())
+    assert publisher.metrics()["queued"] == len({partition(i, 4) for i in range(10)})
+    for key in {key for key, _ in exchange.published}:
+        sensor_ids = [sensor_id for k, sensor_id in exchange.published if k == key]
+        assert {partition(sensor_id, 4) for sensor_id in sensor_ids} == {int(key)}
+        assert sensor_ids == [i % 10 for i in range(40) if partition(i % 10, 4) == int(key)]
+
+
+def test_jump_hash_only_moves_sensors_to_a_new_partition():
+    before = [jump_hash(i, 4) for i in range(1, 10001)]
+    after = [jump_hash(i, 5) for i in range(1, 10001)]
+    assert all(a == b or a == 4 for a, b in zip(after, before))
+    assert all(1800 < before.count(p) < 3200 for p in range(4))
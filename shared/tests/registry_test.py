@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+
+from shared import registry as registry_module
+from shared.registry import BackendUnavailable, ClientRegistry
+
+
+class FakeClient:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def test_backends_connect_in_parallel():
+    async def slow(name):
+        await asyncio.sleep(0.2)
+        return {name: FakeClient()}
+
+    async def run():
+        registry = ClientRegistry(steps={"redis": lambda: slow("redis"), "mongodb": lambda: slow("mongodb")})
+        await registry.start()
+        assert registry.ready()
+        assert registry.started_in < 0.35
+        assert registry.startup["redis"]["status"] == "ready"
+        redis = registry.redis()
+        await registry.close()
+        assert redis.closed
+
+    asyncio.run(run())
+
+
+def test_unavailable_backend_is_retried_in_the_background():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            await asyncio.sleep(1)
+        return {"mongodb": FakeClient()}
+
+    async def run():
+        registry = ClientRegistry(timeout=0.1, steps={"mongodb": flaky})
+        await registry.start()
+        assert not registry.ready()
+        assert registry.startup["mongodb"]["status"] == "failed"
+        with pytest.raises(BackendUnavailable):
+            registry.mongodb()
+        await asyncio.sleep(0.7)
+        assert registry.ready()
+        assert registry.mongodb() is not None
+        await registry.close()
+
+    asyncio.run(run())
+
+
+def test_late_cassandra_client_is_closed(monkeypatch):
+    clients = []
+
+    class SlowCassandra:
+        closed = False
+
+        def __init__(self, hosts):
+            time.sleep(0.3)
+            clients.append(self)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(registry_module, "CassandraClient", SlowCassandra)
+
+    async def run():
+        registry = ClientRegistry(timeout=0.1)
+        registry.steps = {"cassandra": registry._start_cassandra}
+        await registry.start()
+        assert registry.startup["cassandra"]["status"] == "failed"
+        await asyncio.sleep(0.4)
+        assert clients and clients[0].closed
+        for task in registry._retries:
+            task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,89 @@
+import asyncio
+
+from shared.sensor_cache import SensorCache
+
+
+class FakeMongo:
+    def __init__(self, ids):
+        self.ids = set(ids)
+        self.calls = 0
+
+    async def get_all_sensors(self, limit):
+        self.calls += 1
+        return [{"id": i} for i in sorted(self.ids)][:limit]
+
+    async def get_sensor(self, query):
+        self.calls += 1
+        return {"id": query["id"]} if query["id"] in self.ids else None
+
+    async def get_sensors(self, field, values):
+        self.calls += 1
+        return [{"id": i} for i in values if i in self.ids]
+
+
+def test_warm_sensors_need_no_round_trip():
+    mongodb = FakeMongo([1, 2, 3])
+    cache = SensorCache(mongodb)
+    asyncio.run(cache.warm())
+    assert asyncio.run(cache.get(2)) == {"id": 2}
+    assert asyncio.run(cache.get_many([1, 3])) == {1: {"id": 1}, 3: {"id": 3}}
+    assert mongodb.calls == 1
+    assert cache.metrics()["hit_ratio"] == 1.0
+
+
+def test_missing_sensors_are_fetched_once():
+    mongodb = FakeMongo([1, 2])
+    cache = SensorCache(mongodb)
+    assert asyncio.run(cache.get_many([1, 2, 9])) == {1: {"id": 1}, 2: {"id": 2}}
+    assert asyncio.run(cache.get(9)) is None
+    assert asyncio.run(cache.get(1)) == {"id": 1}
+    assert mongodb.calls == 1
+    assert cache.metrics()["hits"] == 2
+
+
+def test_an_event_evicts_the_sensor():
+    mongodb = FakeMongo([])
+    cache = SensorCache(mongodb)
+    assert asyncio.run(cache.get(1)) is None
+    mongodb.ids.add(1)
+    cache.invalidate(1)
+    assert asyncio.run(cache.get(1)) == {"id": 1}
+
+
+def test_a_lookup_overtaken_by_an_event_is_not_cached():
+    mongodb = FakeMongo([1])
+    cache = SensorCache(mongodb)
+    get_sensor = mongodb.get_sensor
+
+    async def invalidated_while_loading(query):
+        document = await get_sensor(query)
+        mongodb.ids.discard(1)
+        cache.invalidate(1)
+        return document
+
+    mongodb.get_sensor = invalidated_while_loading
+    assert asyncio.run(cache.get(1)) == {"id": 1}
+    mongodb.get_sensor = get_sensor
+    assert asyncio.run(cache.get(1)) is None
+
+
+def test_entries_expire():
+    mongodb = FakeMongo([1])
+    cache = SensorCache(mongodb, ttl=0)
+    asyncio.run(cache.get(1))
+    asyncio.run(cache.get(1))
+    assert mongodb.calls == 2
+
+
+def test_least_recently_used_are_evicted():
+    mongodb = FakeMongo([1, 2, 3])
+    cache = SensorCache(mongodb, max_size=2)
+    asyncio.run(cache.get_many([1, 2]))
+    asyncio.run(cache.get(1))
+    asyncio.run(cache.get(3))
+    assert cache.metrics()["size"] == 2
+    calls = mongodb.calls
+    asyncio.run(cache.get(1))
+    assert mongodb.calls == calls
+    asyncio.run(cache.get(2))
+    assert mongodb.calls == calls + 1
@@ -0,0 +1,52 @@
+import pytest
+
+from shared.spill import SpillFile, SpillFull
+
+RECORDS = [("sensor_data", "", "1f0c", b'{"sensor_id": 1}'), ("", "sensors.elasticsearch", "9a3e", b'{"action": "delete"}')]
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), 1024)
+    spill.append(RECORDS)
+    assert spill.read(1) == RECORDS[:1]
+    spill.commit()
+    # Appends while draining go to a new log, read after the current one
+    spill.append(RECORDS[:1])
+    assert spill.read(10) == RECORDS[1:]
+    spill.commit()
+    assert spill.read(10) == RECORDS[:1]
+    spill.commit()
+    assert not spill.pending()
+    assert not list(tmp_path.iterdir())
+
+
+def test_an_uncommitted_read_is_read_again(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), 1024)
+    spill.append(RECORDS)
+    assert spill.read(10) == RECORDS
+    assert spill.read(10) == RECORDS
+
+
+def test_a_spill_file_survives_a_restart(tmp_path):
+    SpillFile(str(tmp_path / "spill"), 1024).append(RECORDS)
+    spill = SpillFile(str(tmp_path / "spill"), 1024)
+    assert spill.pending()
+    assert spill.read(10) == RECORDS
+
+
+def test_a_torn_frame_is_dropped(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), 1024)
+    spill.append(RECORDS)
+    with open(spill.log_path, "ab") as f:
+        f.write(b"\x00\x0b")
+    spill.bytes += 2
+    assert spill.read(10) == RECORDS
+    spill.commit()
+    assert not spill.pending()
+
+
+def test_appends_over_the_limit_are_rejected(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), 50)
+    with pytest.raises(SpillFull):
+        spill.append(RECORDS)
+    assert not spill.pending()
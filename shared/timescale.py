@@ -1,34 +1,136 @@
+import contextlib
+import asyncpg
 import psycopg2
+import psycopg2.errors
 import os
+import time
+import uuid
+from psycopg2.extensions import connection as PgConnection
+
+
+class PreparingConnection(PgConnection):
+    # Remembers which statements have been PREPAREd in this session
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def connection_params():
+    return dict(
+        host=os.environ.get("TS_HOST"),
+        port=os.environ.get("TS_PORT"),
+        user=os.environ.get("TS_USER"),
+        password=os.environ.get("TS_PASSWORD"),
+        database=os.environ.get("TS_DBNAME"),
+        connection_factory=PreparingConnection)
 
 
 class Timescale:
     def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.environ.get("TS_HOST"),
-            port=os.environ.get("TS_PORT"),
-            user=os.environ.get("TS_USER"),
-            password=os.environ.get("TS_PASSWORD"),
-            database=os.environ.get("TS_DBNAME"))
+        self.conn = psycopg2.connect(**connection_params())
         self.cursor = self.conn.cursor()
-        
+
     def getCursor(self):
             return self.cursor
 
     def close(self):
         self.cursor.close()
         self.conn.close()
-    
+
     def ping(self):
         return self.conn.ping()
-    
-    def execute(self, query):
-       return self.cursor.execute(query)
-    
+
+    def execute(self, query, params=None):
+        # Values always go in params as %s placeholders, never formatted into the query
+        return self.cursor.execute(query, params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def execute_prepared(self, name, types, query, params):
+        # PREPAREs query ($1, $2... placeholders) the first time this connection sees it
+        # and EXECUTEs it afterwards, so the statement is parsed and planned once per session
+        prepared = self.conn.prepared
+        if name not in prepared:
+            self.cursor.execute(f"PREPARE {name} ({', '.join(types)}) AS {query}")
+            prepared.add(name)
+        placeholders = ", ".join(f"%s::{t}" for t in types)
+        try:
+            return self.cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            prepared.discard(name)
+            raise
+
+    def stream(self, query, params=None, chunk_size=1000):
+        # Named (server-side) cursor, only chunk_size rows are held in memory at a time
+        with self.conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def refresh_aggregate(self, view, start, end):
+        # refresh_continuous_aggregate can't run inside a transaction block
+        self.conn.commit()
+        self.conn.autocommit = True
+        try:
+            self.cursor.execute("CALL refresh_continuous_aggregate(%s, %s, %s)", (view, start, end))
+        finally:
+            self.conn.autocommit = False
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
     def delete(self, table):
         self.cursor.execute("DELETE FROM " + table)
         self.conn.commit()
 
-        
-     
-         
+
+class AsyncTimescalePool:
+    # asyncpg pool for the API. asyncpg prepares every statement the first time a connection
+    # runs it and keeps it in a per-connection cache, so there is no explicit PREPARE here
+    def __init__(self, maxconn=10, stats=None):
+        self.size = maxconn
+        self.stats = stats
+        self._pool = None
+
+    async def start(self):
+        params = connection_params()
+        self._pool = await asyncpg.create_pool(
+            host=params["host"],
+            port=int(params["port"]) if params["port"] else None,
+            user=params["user"],
+            password=params["password"],
+            database=params["database"],
+            min_size=1,
+            max_size=self.size)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self._pool.acquire() as conn:
+            if self.stats is not None:
+                self.stats.record(time.perf_counter() - start)
+            yield conn
+
+    async def close(self):
+        await self._pool.close()
+
+
+async def stream_records(conn, query, params, chunk_size=1000):
+    # Server-side cursor (needs a transaction), yields lists of at most chunk_size rows
+    async with conn.transaction():
+        chunk = []
+        async for record in conn.cursor(query, *params, prefetch=chunk_size):
+            chunk.append(tuple(record))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk